@@ -0,0 +1,67 @@
+'''对比不同多卡同步策略下的训练吞吐，CPU + gloo后端运行
+
+用法:
+    python benchmarks/bench_dist_sync.py [steps]
+'''
+import sys
+import time
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torchelper.utils.dist_util import should_barrier
+
+POLICIES = ['none', 'epoch', 10, 1]
+WORLD_SIZES = [2, 4, 8]
+
+
+def run(rank, world_size, port, steps, result_queue):
+    torch.set_num_threads(1)
+    dist.init_process_group(backend='gloo',
+                            init_method='tcp://127.0.0.1:' + str(port),
+                            world_size=world_size,
+                            rank=rank)
+    torch.manual_seed(rank)
+    net = nn.Sequential(nn.Linear(256, 256), nn.ReLU(), nn.Linear(256, 256))
+    net = DistributedDataParallel(net)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.01)
+    data = torch.randn(32, 256)
+    for policy in POLICIES:
+        # 预热
+        for i in range(5):
+            optimizer.zero_grad()
+            net(data).mean().backward()
+            optimizer.step()
+        dist.barrier()
+        start = time.perf_counter()
+        for i in range(steps):
+            optimizer.zero_grad()
+            net(data).mean().backward()
+            optimizer.step()
+            if should_barrier(policy, i):
+                dist.barrier()
+        if should_barrier(policy, -1, epoch_end=True):
+            dist.barrier()
+        elapsed = time.perf_counter() - start
+        if rank == 0:
+            result_queue.put((world_size, str(policy), steps / elapsed))
+    dist.destroy_process_group()
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ctx = mp.get_context('spawn')
+    port = 23456
+    print('%-6s %-8s %12s' % ('ranks', 'policy', 'steps/sec'))
+    for world_size in WORLD_SIZES:
+        result_queue = ctx.Queue()
+        mp.spawn(run, nprocs=world_size, args=(world_size, port, steps, result_queue))
+        for __ in POLICIES:
+            ws, policy, speed = result_queue.get()
+            print('%-6d %-8s %12.1f' % (ws, policy, speed))
+        port += 1
+
+
+if __name__ == '__main__':
+    main()
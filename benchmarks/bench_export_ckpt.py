@@ -0,0 +1,54 @@
+'''对比StyleGAN2Generator权重用torch.save保存与导出格式(fp16/bf16 + 无损压缩)的保存/加载速度和文件大小
+
+用法:
+    python benchmarks/bench_export_ckpt.py [out_size] [repeat]
+'''
+import os
+import sys
+import time
+import tempfile
+import torch
+from torchelper.archs.style_gan import StyleGAN2Generator
+from torchelper.utils.ckpt_io import save_file, load_file, pack_weights, unpack_weights
+
+CONFIGS = [('fp16', None), ('fp16', 'zlib'), ('bf16', 'zlib'), ('fp16', 'lzma')]
+
+
+def bench(save, load, path, repeat):
+    save_time, load_time = 0.0, 0.0
+    for __ in range(repeat):
+        start = time.perf_counter()
+        save(path)
+        save_time += time.perf_counter() - start
+        start = time.perf_counter()
+        load(path)
+        load_time += time.perf_counter() - start
+    return save_time / repeat, load_time / repeat, os.path.getsize(path)
+
+
+def report(name, save_time, load_time, size, base_size):
+    mb = size / 1024 / 1024
+    print('%-12s save %7.1f MB/s  load %7.1f MB/s  size %7.1f MB (%.2fx)' %
+          (name, base_size / 1024 / 1024 / save_time, base_size / 1024 / 1024 / load_time, mb, base_size / size))
+
+
+def main():
+    out_size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    torch.manual_seed(0)
+    weights = StyleGAN2Generator(out_size).state_dict()
+    dtypes = dict([(k, v.dtype) for k, v in weights.items()])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'weights.pth')
+        # 吞吐都按原始fp32权重的大小计算
+        save_time, load_time, base_size = bench(lambda p: torch.save(weights, p),
+                                                lambda p: torch.load(p, map_location='cpu'), path, repeat)
+        report('torch.save', save_time, load_time, base_size, base_size)
+        for dtype, codec in CONFIGS:
+            save_time, load_time, size = bench(lambda p: save_file(pack_weights(weights, dtype, codec), p, fsync=False),
+                                               lambda p: unpack_weights(load_file(p, mmap=False), dtypes), path, repeat)
+            report('%s+%s' % (dtype, codec), save_time, load_time, size, base_size)
+
+
+if __name__ == '__main__':
+    main()
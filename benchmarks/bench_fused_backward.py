@@ -0,0 +1,126 @@
+'''对比ModelBuilder逐个模型反向传播(ModelBuilder.backward)与合并反向传播(fused_backward)的训练速度，
+并检查两者的梯度一致，CPU单进程运行
+
+两种情况:
+    detached:    判别器的输入对生成器输出detach，生成器的loss不经过判别器，两个loss的计算图不相交，
+                 合并反向传播的梯度应与逐个反向传播一致
+    adversarial: 生成器的对抗loss经过判别器，逐个反向传播时判别器的zero_grad会清掉生成器loss的梯度，
+                 合并反向传播无法区分，应当抛出ValueError
+
+用法:
+    python benchmarks/bench_fused_backward.py [steps]
+'''
+import sys
+import time
+import torch
+import torch.nn as nn
+from torchelper.models.base_model import BaseModel
+from torchelper.models.model_builder import ModelBuilder
+from torchelper.utils.dist_util import init_device
+
+
+class ToyModel(BaseModel):
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.net = nn.Sequential(nn.Linear(512, 512), nn.ReLU(), nn.Linear(512, 512), nn.ReLU(), nn.Linear(512, 512))
+        self.loss = None
+
+    def forward(self, x):
+        return self.net(x)
+
+    def get_loss(self):
+        return self.loss
+
+
+class ToyBuilder(ModelBuilder):
+    '''生成器-判别器式的两个模型，反向传播使用ModelBuilder的实现
+    '''
+    def __init__(self, adversarial:bool):
+        super().__init__(True, None)
+        self.adversarial = adversarial
+        self.add_model('g', ToyModel({'init_lr': 1e-4}))
+        self.add_model('d', ToyModel({'init_lr': 1e-4}))
+
+    def model_to_device(self, net, find_unused_parameters=False):
+        # 单进程运行不需要DDP
+        return net.to(self.device)
+
+    def forward(self, epoch, step, data):
+        fake = self.models['g'](data)
+        g_loss = (fake - data).abs().mean()
+        if self.adversarial:
+            g_loss = g_loss + self.models['d'](fake).mean()
+        self.models['g'].loss = g_loss
+        self.models['d'].loss = self.models['d'](fake.detach()).pow(2).mean()
+
+
+def bench(builder, data, steps):
+    for i in range(5):
+        builder.forward_wrapper(0, i, data)
+        builder.backward_wrapper()
+    start = time.perf_counter()
+    for i in range(steps):
+        builder.forward_wrapper(0, i, data)
+        builder.backward_wrapper()
+    return steps / (time.perf_counter() - start)
+
+
+def first_step_grads(fused, data):
+    '''相同初始化下第一个step反向后的梯度
+    '''
+    torch.manual_seed(0)
+    builder = ToyBuilder(False)
+    builder.set_fused_backward(fused)
+    builder.forward_wrapper(0, 0, data)
+    builder.backward_wrapper()
+    grads = {}
+    for name, model in builder.models.items():
+        for k, p in model.named_parameters():
+            grads[name + '.' + k] = p.grad.detach().clone()
+    return grads
+
+
+def fused_rejected(data):
+    '''生成器的loss经过判别器时合并反向传播是否抛出ValueError
+    '''
+    torch.manual_seed(0)
+    builder = ToyBuilder(True)
+    builder.set_fused_backward(True)
+    builder.forward_wrapper(0, 0, data)
+    try:
+        builder.backward_wrapper()
+    except ValueError as e:
+        print('[adversarial] fused backward rejected: %s' % e)
+        return True
+    return False
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    init_device('cpu')
+    torch.manual_seed(0)
+    data = torch.randn(64, 512)
+
+    seq_grads = first_step_grads(False, data)
+    fused_grads = first_step_grads(True, data)
+    max_diff = max([(seq_grads[k] - fused_grads[k]).abs().max().item() for k in seq_grads.keys()])
+    match = all([torch.allclose(seq_grads[k], fused_grads[k], rtol=1e-5, atol=1e-6) for k in seq_grads.keys()])
+
+    torch.manual_seed(0)
+    seq = bench(ToyBuilder(False), data, steps)
+    torch.manual_seed(0)
+    builder = ToyBuilder(False)
+    builder.set_fused_backward(True)
+    fused = bench(builder, data, steps)
+    print('[detached] sequential: %.1f steps/sec, fused: %.1f steps/sec (%.2fx), grad max diff %.2e %s' %
+          (seq, fused, fused / seq, max_diff, 'OK' if match else 'MISMATCH'))
+
+    rejected = fused_rejected(data)
+    if not rejected:
+        print('[adversarial] fused backward was NOT rejected')
+    if not (match and rejected):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+'''统计`import torchelper`的耗时，并检查是否提前加载了较重的依赖，超出预算时返回非0
+
+用法:
+    python benchmarks/bench_import_time.py [budget_ms]
+'''
+import os
+import sys
+import json
+import subprocess
+
+# import torchelper 之后不应该出现在sys.modules中的模块
+HEAVY_MODULES = ['torch', 'cv2', 'lpips', 'scipy', 'skimage', 'requests', 'tensorboard', 'torch.utils.tensorboard']
+
+SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import torchelper
+elapsed = time.perf_counter() - start
+print(json.dumps({'ms': elapsed * 1000, 'loaded': [m for m in %r if m in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+def measure(repeat=5):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    results = []
+    for __ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', SCRIPT], stdout=subprocess.PIPE, env=env, check=True)
+        results.append(json.loads(out.stdout.decode('utf-8').strip().split('\n')[-1]))
+    return results
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    results = measure()
+    times = sorted(r['ms'] for r in results)
+    median = times[len(times) // 2]
+    loaded = results[-1]['loaded']
+    print('import torchelper: median %.1fms (min %.1fms, max %.1fms), budget %.1fms' % (median, times[0], times[-1], budget_ms))
+    if len(loaded) > 0:
+        print('heavy modules loaded at import time:', ', '.join(loaded))
+    if median > budget_ms or len(loaded) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''对比MultiDirDataset样本表用python list/dict与SampleTable保存时的内存占用，
+以及fork出的worker遍历所有样本后新增的私有内存（写时复制），仅支持Linux
+
+用法:
+    python benchmarks/bench_sample_table.py [num_samples] [num_dirs]
+'''
+import os
+import sys
+import gc
+from torchelper.data.sample_table import SampleTable
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def private_dirty_mb():
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total / 1024
+
+
+def make_dirs(num_samples, num_dirs):
+    per_dir = num_samples // num_dirs
+    for d in range(num_dirs):
+        yield 'id_%06d/imgs' % d, ['%08d.png' % i for i in range(per_dir)]
+
+
+def build_list(num_samples, num_dirs):
+    names, labels = [], {}
+    for pre_name, dir_names in make_dirs(num_samples, num_dirs):
+        for name in dir_names:
+            key = pre_name + '/' + name
+            names.append(key)
+            labels[key] = len(names) % 1000
+    return names, labels
+
+
+def build_table(num_samples, num_dirs):
+    table = SampleTable()
+    labels = {}
+    for pre_name, dir_names in make_dirs(num_samples, num_dirs):
+        table.add_dir(pre_name, dir_names)
+        for name in dir_names:
+            labels[pre_name + '/' + name] = len(labels) % 1000
+    table.finalize(labels)
+    return table
+
+
+def worker_growth(read):
+    '''fork一个进程模拟DataLoader worker遍历一个epoch，返回遍历后子进程新增的私有内存
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = private_dirty_mb()
+        read()
+        os.write(w, ('%f' % (private_dirty_mb() - before)).encode('utf-8'))
+        os._exit(0)
+    os.close(w)
+    res = float(os.read(r, 64).decode('utf-8'))
+    os.waitpid(pid, 0)
+    return res
+
+
+def main():
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    num_dirs = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    base = rss_mb()
+    names, labels = build_list(num_samples, num_dirs)
+    gc.collect()
+    list_mb = rss_mb() - base
+    def read_list():
+        for i in range(len(names)):
+            labels.get(names[i], None)
+    list_growth = worker_growth(read_list)
+    del names, labels
+    gc.collect()
+
+    base = rss_mb()
+    table = build_table(num_samples, num_dirs)
+    gc.collect()
+    table_mb = rss_mb() - base
+    def read_table():
+        for i in range(len(table)):
+            table[i]
+            table.get_label(i)
+    table_growth = worker_growth(read_table)
+
+    print('samples: %d, dirs: %d' % (num_samples, num_dirs))
+    print('list/dict:   rss %8.1f MB, forked worker after one epoch +%8.1f MB' % (list_mb, list_growth))
+    print('SampleTable: rss %8.1f MB (arrays %.1f MB), forked worker after one epoch +%8.1f MB' %
+          (table_mb, table.nbytes() / 1024 / 1024, table_growth))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import os
+import pytest
+from torchelper.utils.ckpt_manifest import CkptManifest
+
+
+def touch(ckpt_dir, name):
+    path = os.path.join(ckpt_dir, name)
+    with open(path, 'wb') as f:
+        f.write(b'0')
+    return path
+
+
+def save(manifest, ckpt_dir, epoch, keep_last=2, metrics=None):
+    manifest.add(epoch, [touch(ckpt_dir, '%d_ckpt_g.pth' % epoch)], metrics)
+    return manifest.prune(keep_last)
+
+
+def test_latest_and_prune_follow_write_order(tmp_path):
+    ckpt_dir = str(tmp_path)
+    manifest = CkptManifest(ckpt_dir, 'g')
+    for epoch in [0, 1, 2]:
+        save(manifest, ckpt_dir, epoch)
+    assert manifest.latest() == 2
+
+    # 重启后写入的epoch比已有的小，仍然是最新的，不能被清理
+    manifest = CkptManifest(ckpt_dir, 'g')
+    removed = save(manifest, ckpt_dir, 0)
+    assert manifest.latest() == 0
+    assert removed == [1]
+    assert os.path.isfile(os.path.join(ckpt_dir, '0_ckpt_g.pth'))
+    assert sorted(int(k) for k in manifest.data['entries'].keys()) == [0, 2]
+
+
+def test_pre_train_save_is_not_latest(tmp_path):
+    ckpt_dir = str(tmp_path)
+    manifest = CkptManifest(ckpt_dir, 'g')
+    save(manifest, ckpt_dir, -1)
+    assert manifest.latest() == -1
+    save(manifest, ckpt_dir, 0)
+    save(manifest, ckpt_dir, -1)
+    assert manifest.latest() == 0
+
+
+def test_restart_after_restore_resumes_next_epoch(tmp_path):
+    pytest.importorskip('torch')
+    from torchelper.callbacks.ckpt_callback import CkptCallback
+
+    class Builder():
+        resume_point = None
+
+        def set_resume_point(self, epoch, step):
+            self.resume_point = (epoch, step)
+
+    class Model():
+        builder = Builder()
+
+        def get_builder(self):
+            return self.builder
+
+    ckpt_dir = str(tmp_path)
+    manifest = CkptManifest(ckpt_dir, 'g')
+    for epoch in [3, 4]:
+        save(manifest, ckpt_dir, epoch)
+
+    cb = CkptCallback(ckpt_dir, 'g', restore_epoch='latest', save_before_train=False)
+    loaded = []
+    cb.load_weights = lambda model, epoch: loaded.append(epoch) or True
+    model = Model()
+    cb.on_begin_train(model)
+    assert loaded == [4]
+    assert model.builder.resume_point == (4, -1)
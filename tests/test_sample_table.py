@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+from torchelper.data.sample_table import SampleTable, LabelView
+
+
+def build(labels):
+    table = SampleTable()
+    table.add_dir('a', ['1.png', '2.png'])
+    table.add_dir('b', ['3.png'])
+    return table.finalize(labels)
+
+
+def test_label_types_are_kept():
+    table = build({'a/1.png': 0, 'a/2.png': 3})
+    assert table.label_array is not None
+    assert type(table.get_label(1)) is int and table.get_label(1) == 3
+    assert table.get_label(2) is None
+
+    # 类型不一致或不是数值时不转换为数组
+    table = build({'a/1.png': 1, 'a/2.png': 2.5, 'b/3.png': [1, 2]})
+    assert table.label_array is None
+    assert type(table.get_label(0)) is int
+    assert type(table.get_label(1)) is float
+    assert table.get_label(2) == [1, 2]
+
+    table = build({'a/1.png': np.zeros(2, dtype=np.float32), 'b/3.png': np.ones(2, dtype=np.float32)})
+    assert table.label_array is not None
+    assert table.get_label(2).dtype == np.float32
+
+
+def test_label_types_survive_save_and_load(tmp_path):
+    path = str(tmp_path / 'table.npz')
+    build({'a/1.png': 1.5, 'b/3.png': 2.0}).save(path)
+    table = SampleTable.load(path)
+    assert type(table.get_label(0)) is float
+    assert SampleTable().load_state_dict(table.state_dict()).get_label(2) == 2.0
+
+
+def test_label_view():
+    labels = LabelView(build({'a/1.png': 'x', 'b/3.png': 'y'}))
+    assert len(labels) == 2
+    assert list(labels) == ['a/1.png', 'b/3.png']
+    assert labels['b/3.png'] == 'y'
+    assert labels.get('a/2.png', None) is None
+    assert 'a/1.png' in labels
@@ -1,17 +1,64 @@
-from .models.model_builder import ModelBuilder
-from .callbacks.callback import Callback
-from .callbacks.ckpt_callback import CkptCallback
-from .callbacks.wechat_send_msg_callback import WechatCallback
-from .callbacks.reduce_lr_on_plateau import ReduceLROnPlateau
-from .models.base_model import BaseModel
-from .utils.config import init_cfg, load_cfg, merge_cfg
-from .train import train_main
-from .metrics import measure
-from .data import *
-from .models.lr_scheduler import LinearDownLR
-from .utils.dist_util import master_only, get_rank
-from .metrics  import *
-from .utils.cls_utils import new_cls 
-from .utils import logger
+'''torchelper的公开接口按需导入(PEP 562)，`import torchelper`时不会加载torch、tensorboard等较重的依赖，
+第一次访问对应名称时才导入所在模块
+'''
+import importlib
 
-name = "torchelper"
\ No newline at end of file
+# 名称 -> (模块, 属性)，属性为None表示名称本身是模块
+_LAZY_ATTRS = {
+    'ModelBuilder': ('.models.model_builder', 'ModelBuilder'),
+    'Callback': ('.callbacks.callback', 'Callback'),
+    'CkptCallback': ('.callbacks.ckpt_callback', 'CkptCallback'),
+    'WechatCallback': ('.callbacks.wechat_send_msg_callback', 'WechatCallback'),
+    'ReduceLROnPlateau': ('.callbacks.reduce_lr_on_plateau', 'ReduceLROnPlateau'),
+    'BaseModel': ('.models.base_model', 'BaseModel'),
+    'init_cfg': ('.utils.config', 'init_cfg'),
+    'load_cfg': ('.utils.config', 'load_cfg'),
+    'merge_cfg': ('.utils.config', 'merge_cfg'),
+    'train_main': ('.train', 'train_main'),
+    'measure': ('.metrics.measure', None),
+    'LinearDownLR': ('.models.lr_scheduler', 'LinearDownLR'),
+    'master_only': ('.utils.dist_util', 'master_only'),
+    'get_rank': ('.utils.dist_util', 'get_rank'),
+    'new_cls': ('.utils.cls_utils', 'new_cls'),
+    'logger': ('.utils.logger', None),
+    # torchelper.data
+    'get_data_loader': ('.data.base_dataset', 'get_data_loader'),
+    'BaseDataset': ('.data.base_dataset', 'BaseDataset'),
+    'MultiDirDataset': ('.data.dir_dataset', 'MultiDirDataset'),
+    'DirDataset': ('.data.dir_dataset', 'DirDataset'),
+    'DataPrefetcher': ('.data.prefetcher', 'DataPrefetcher'),
+    'DirIndex': ('.data.dir_index', 'DirIndex'),
+    'SampleTable': ('.data.sample_table', 'SampleTable'),
+    'ImageCache': ('.data.img_cache', 'ImageCache'),
+    'SharedImageArena': ('.data.shm_arena', 'SharedImageArena'),
+    'MmapDataset': ('.data.mmap_dataset', 'MmapDataset'),
+    'pack_dataset': ('.data.mmap_dataset', 'pack_dataset'),
+    'TarShardDataset': ('.data.tar_dataset', 'TarShardDataset'),
+    'ZipDirDataset': ('.data.zip_dataset', 'ZipDirDataset'),
+    # torchelper.metrics
+    'FID': ('.metrics.fid', 'FID'),
+    'PSNR': ('.metrics.psnr', 'PSNR'),
+    'SSIM': ('.metrics.ssim', 'SSIM'),
+    'SSIMNet': ('.metrics.ssim', 'SSIMNet'),
+    'LPIPS': ('.metrics.lpips', 'LPIPS'),
+    'Metric': ('.metrics.measure', 'Metric'),
+}
+
+__all__ = list(_LAZY_ATTRS.keys())
+
+name = "torchelper"
+
+
+def __getattr__(attr):
+    if attr not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, attr))
+    module_name, attr_name = _LAZY_ATTRS[attr]
+    module = importlib.import_module(module_name, __name__)
+    value = module if attr_name is None else getattr(module, attr_name)
+    # 缓存到模块全局变量，之后的访问不再经过__getattr__
+    globals()[attr] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -1,30 +1,299 @@
 import os
+import random
 import torch
 import time
+import numpy as np
  
 from .callback import Callback
 from torchelper.models.base_model import BaseModel
-from torchelper.utils.dist_util import master_only, get_bare_model
+from torchelper.utils.dist_util import master_only, get_bare_model, broadcast_call
+from torchelper.utils.ckpt_io import save_file, load_file, build_index, snapshot_state, tensor_hash, AsyncSaver, BlobStore, \
+    pack_weights, unpack_weights, is_packed, EXPORT_DTYPES, EXPORT_CODECS
+from torchelper.utils.ckpt_manifest import CkptManifest
 
 class CkptCallback(Callback):
-    def __init__(self, ckpt_dir, name, restore_epoch=-1, max_ckpts=10, save_per_secs=2*60*60, strict=False, save_before_train=True):
+    '''保存/加载模型和optimizer
+
+    Args:
+        ckpt_dir: str, 保存目录
+        name: str, 模型名称，用于文件命名
+        restore_epoch: int/str, 训练开始时加载的epoch，'latest'/'best'表示从manifest中查找最新/最优的checkpoint
+        max_ckpts: int, 最多保留的最近checkpoint数量，<=0不清除
+        save_per_secs: int, 每隔多少秒永久保留一个checkpoint
+        strict: bool, 加载权重时是否严格匹配
+        save_before_train: bool, 训练开始前是否保存一次
+        save_per_steps: int, >0时每隔多少个step保存一次断点续训状态(state_<name>.pth)，
+            训练开始时若该文件存在则从保存的epoch和step继续；梯度累积时推迟到之后第一个累积边界保存
+        async_save: bool, 是否在后台线程保存，训练线程只做state_dict的快照
+        max_inflight: int, 异步保存时最多未完成的保存数量，超过时下一次保存会等待
+        staging: bool, 异步保存时gpu上的tensor先在显存中复制，拷贝到内存也放到后台线程
+        ckpt_format: str, 'split': 权重和optimizer分别保存为<epoch>_weights_<name>.pth和<epoch>_optimizer_<name>.pth；
+            'single': 权重、optimizer、GradScaler、epoch、step和tensor索引保存为一个<epoch>_ckpt_<name>.pth，
+            加载时内存映射文件，只读取用到的tensor
+        broadcast_restore: bool, 恢复时只由rank0读取checkpoint文件，再按桶广播给其他rank，
+            避免所有rank同时读取共享存储上的同一个文件
+        keep_best: int, 清理时额外保留monitor指标最优的checkpoint数量
+        monitor: str, 选择最优checkpoint的指标，取自model.get_metric_dict()
+        mode: str, 'min'或'max'，monitor越小/越大越好
+        dedup: bool, 单文件checkpoint和断点续训状态中，冻结的参数(requires_grad=False)以及自上次保存后没有变化的tensor
+            按内容哈希保存到ckpt_dir/blobs下，只写一次，之后的checkpoint只保存引用；
+            需要ckpt_format='single'或save_per_steps>0，split格式不支持，否则抛出ValueError
+        export_dtype: str, None/'fp16'/'bf16'，不为None时每次保存checkpoint额外导出一份只含权重的<epoch>_export_<name>.pth，
+            浮点参数以该精度保存，与全精度的训练checkpoint相互独立，用load_export加载时自动转换回模型参数的dtype
+        export_codec: str, None/'zlib'/'lzma'，导出权重使用的无损压缩算法
+    '''
+    def __init__(self, ckpt_dir, name, restore_epoch=-1, max_ckpts=10, save_per_secs=2*60*60, strict=False, save_before_train=True,
+                 save_per_steps=-1, async_save=False, max_inflight=1, staging=True, ckpt_format='split',
+                 broadcast_restore=False, keep_best=0, monitor=None, mode='min', dedup=False,
+                 export_dtype=None, export_codec='zlib'):
         super().__init__()
         self.name = name
         self.strict = strict
         self.ckpt_dir = ckpt_dir
         self.restore_epoch = restore_epoch
-        self.epochs = []
         self.last_save_time = -1
         self.max_ckpts=max_ckpts
         self.save_per_secs = save_per_secs
         self.save_before_train = save_before_train
+        self.save_per_steps = save_per_steps
+        self.async_save = async_save
+        self.max_inflight = max_inflight
+        self.staging = staging
+        self.saver = None
+        if ckpt_format not in ['split', 'single']:
+            raise ValueError('Unknown ckpt_format: ' + str(ckpt_format))
+        self.ckpt_format = ckpt_format
+        self.broadcast_restore = broadcast_restore
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self.mode = mode
+        self.manifest = None
+        if dedup and ckpt_format != 'single' and save_per_steps <= 0:
+            raise ValueError("dedup requires ckpt_format='single' or save_per_steps>0, "
+                             "the split format saves plain state_dicts")
+        self.dedup = dedup
+        self.blob_store = BlobStore(os.path.join(ckpt_dir, 'blobs'))
+        # key -> (data_ptr, _version, hash)，用于判断tensor自上次保存后是否被修改
+        self.tensor_hashes = {}
+        # 已到保存间隔，等待梯度累积边界
+        self.step_save_pending = False
+        if export_dtype is not None and export_dtype not in EXPORT_DTYPES:
+            raise ValueError('Unknown export_dtype: ' + str(export_dtype))
+        if export_codec not in EXPORT_CODECS:
+            raise ValueError('Unknown export_codec: ' + str(export_codec))
+        self.export_dtype = export_dtype
+        self.export_codec = export_codec
+
+    def get_manifest(self):
+        if self.manifest is None:
+            self.manifest = CkptManifest(self.ckpt_dir, self.name, self.monitor, self.mode)
+        return self.manifest
+
+    def get_restore_epoch(self):
+        '''解析restore_epoch，'latest'/'best'从manifest中查找，找不到返回None
+        '''
+        if self.restore_epoch == 'latest':
+            return self.get_manifest().latest()
+        if self.restore_epoch == 'best':
+            return self.get_manifest().best()
+        return self.restore_epoch
+
+    def get_metrics(self, model:BaseModel):
+        '''保存到manifest中的指标
+        '''
+        get_metric_dict = getattr(model, 'get_metric_dict', None)
+        metrics = get_metric_dict() if get_metric_dict is not None else None
+        if not isinstance(metrics, dict):
+            return {}
+        res = {}
+        for k, v in metrics.items():
+            try:
+                res[k] = float(v)
+            except (TypeError, ValueError):
+                continue
+        return res
+
+    def write_files(self, jobs, on_done=None):
+        '''保存[(obj, path)]或[(obj, path, encode)]，异步模式下先快照再交给后台线程
+        :param on_done: 所有文件写完后调用
+        '''
+        if self.async_save:
+            if self.saver is None:
+                self.saver = AsyncSaver(self.max_inflight)
+            self.saver.submit([(snapshot_state(job[0], self.staging),) + tuple(job[1:]) for job in jobs], on_done)
+            return
+        for job in jobs:
+            obj, path = job[0], job[1]
+            if len(job) > 2 and job[2] is not None:
+                obj = job[2](obj)
+            save_file(obj, path)
+            print('save:', path)
+        if on_done is not None:
+            on_done()
+
+    def read_file(self, path):
+        '''读取checkpoint文件，文件不存在时返回None。
+        broadcast_restore时只有rank0读取，其他rank通过广播得到相同内容，所有rank都需要调用；
+        rank0读取失败(文件损坏、缺少blob)时所有rank都抛出异常
+        '''
+        def read():
+            return self.resolve_blobs(load_file(path)) if os.path.isfile(path) else None
+        if not self.broadcast_restore:
+            return read()
+        return broadcast_call(read)
+
+    def get_state_path(self):
+        return os.path.join(self.ckpt_dir, "state_%s.pth" % self.name)
+
+    def get_ckpt_path(self, epoch):
+        return os.path.join(self.ckpt_dir, "%s_ckpt_%s.pth" % (epoch, self.name))
+
+    def get_export_path(self, epoch):
+        return os.path.join(self.ckpt_dir, '%s_export_%s.pth' % (epoch, self.name))
+
+    def build_ckpt(self, model:BaseModel, epoch, step):
+        '''把权重、optimizer、GradScaler、epoch、step和权重的tensor索引打包成一个dict
+        '''
+        builder = model.get_builder()
+        scaler = builder.get_scaler(model) if builder is not None else None
+        optimizer = model.get_optimizer()
+        weights = get_bare_model(model).state_dict()
+        return {
+            'epoch': epoch,
+            'step': step,
+            'weights': weights,
+            'optimizer': optimizer.state_dict() if optimizer is not None else None,
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'index': {'weights': build_index(weights)},
+        }
+
+    def dedup_weights(self, model:BaseModel, ckpt:dict):
+        '''把ckpt中冻结或未变化的权重替换为blob引用
+        :return: (blob写入任务[(obj, path)], 引用的哈希列表)
+        '''
+        if not self.dedup:
+            return [], []
+        frozen = set([k for k, p in get_bare_model(model).named_parameters() if not p.requires_grad])
+        weights = type(ckpt['weights'])()
+        blob_refs = {}
+        jobs = []
+        for k, v in ckpt['weights'].items():
+            cached = self.tensor_hashes.get(k, None)
+            version = (v.data_ptr(), v._version)
+            unchanged = cached is not None and cached[:2] == version
+            if not (k in frozen or unchanged):
+                self.tensor_hashes[k] = version + (None,)
+                weights[k] = v
+                continue
+            h = cached[2] if unchanged and cached[2] is not None else tensor_hash(v)
+            self.tensor_hashes[k] = version + (h,)
+            if not self.blob_store.has(h) and self.blob_store.path(h) not in [path for __, path in jobs]:
+                jobs.append((v, self.blob_store.path(h)))
+            blob_refs[k] = h
+        ckpt['weights'] = weights
+        ckpt['blob_refs'] = blob_refs
+        return jobs, sorted(set(blob_refs.values()))
+
+    def resolve_blobs(self, ckpt):
+        '''把ckpt中的blob引用替换回tensor
+        '''
+        if not isinstance(ckpt, dict) or len(ckpt.get('blob_refs', {})) == 0:
+            return ckpt
+        for k, h in ckpt['blob_refs'].items():
+            ckpt['weights'][k] = self.blob_store.get(h)
+        ckpt['blob_refs'] = {}
+        return ckpt
+
+    def gc_blobs(self):
+        '''删除没有被任何checkpoint引用的blob，当前模型的哈希也保留，避免删除正在保存的checkpoint引用的blob
+        '''
+        keep = self.get_manifest().referenced_blobs()
+        keep.update([v[2] for v in self.tensor_hashes.values() if v[2] is not None])
+        self.blob_store.gc(keep)
+
+    def apply_ckpt(self, model:BaseModel, ckpt:dict):
+        '''加载build_ckpt格式的checkpoint，mmap加载时只有load_state_dict拷贝的tensor会被读取
+        '''
+        bare_model = get_bare_model(model)
+        weights = bare_model.remap_weights_name(ckpt['weights'])
+        if not self.strict:
+            # 只比较shape，不读取tensor数据，跳过形状不一致的权重
+            model_state = bare_model.state_dict()
+            skip = [k for k, v in weights.items() if k in model_state and tuple(v.shape) != tuple(model_state[k].shape)]
+            for k in skip:
+                print('skip weights with mismatched shape:', k)
+                del weights[k]
+        bare_model.load_state_dict(weights, strict=self.strict)
+        optimizer = model.get_optimizer()
+        if optimizer is not None and ckpt.get('optimizer', None) is not None:
+            optimizer.load_state_dict(ckpt['optimizer'])
+        builder = model.get_builder()
+        scaler = builder.get_scaler(model) if builder is not None else None
+        if scaler is not None and ckpt.get('scaler', None) is not None:
+            scaler.load_state_dict(ckpt['scaler'])
+
+    def get_rng_state(self):
+        state = {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+        }
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            state['cuda'] = torch.cuda.get_rng_state()
+        return state
+
+    def set_rng_state(self, state):
+        random.setstate(state['python'])
+        np.random.set_state(state['numpy'])
+        torch.set_rng_state(state['torch'])
+        if 'cuda' in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state(state['cuda'])
+
+    @master_only
+    def save_state(self, model:BaseModel, epoch, step):
+        '''保存断点续训状态：模型、optimizer、GradScaler、随机数状态，
+        以及sampler的位置（epoch和已完成的step，step为-1表示该epoch已完成）
+        '''
+        state = self.build_ckpt(model, epoch, step)
+        state['rng'] = self.get_rng_state()
+        blob_jobs, blobs = self.dedup_weights(model, state)
+        manifest = self.get_manifest()
+        def on_done():
+            if self.dedup:
+                manifest.set_state_blobs(blobs)
+        # blob先于引用它的文件写入
+        self.write_files(blob_jobs + [(state, self.get_state_path())], on_done)
+
+    def load_state(self, model:BaseModel):
+        '''加载断点续训状态，并把续训位置告诉builder
+        :return: bool, 是否加载成功
+        '''
+        save_path = self.get_state_path()
+        state = self.read_file(save_path)
+        if state is None:
+            return False
+        self.apply_ckpt(model, state)
+        self.set_rng_state(state['rng'])
+        builder = model.get_builder()
+        if builder is not None:
+            builder.set_resume_point(state['epoch'], state['step'])
+        print("success load state: %s, epoch: %s, step: %s" % (save_path, state['epoch'], state['step']))
+        return True
     
     def load_weights(self, model, epoch):
+        # 0. 优先加载单文件checkpoint
+        ckpt_path = self.get_ckpt_path(epoch)
+        ckpt = self.read_file(ckpt_path)
+        if ckpt is not None:
+            self.apply_ckpt(model, ckpt)
+            print("success load ckpt:", ckpt_path)
+            return True
+
         # 1. load weights
         save_filename = "%s_weights_%s.pth" % (epoch, self.name)
         save_path = os.path.join(self.ckpt_dir, save_filename)
-        if os.path.exists(save_path):
-            weights = torch.load(save_path, map_location=lambda storage, loc: storage)
+        weights = self.read_file(save_path)
+        if weights is not None:
             weights = get_bare_model(model).remap_weights_name(weights)
             get_bare_model(model).load_state_dict(weights, strict=self.strict)
             print("success load model:"+ save_path)
@@ -37,11 +306,11 @@ class CkptCallback(Callback):
         if optimizer is not None:
             save_filename = "%s_optimizer_%s.pth" % (epoch, self.name)
             save_path = os.path.join(self.ckpt_dir, save_filename)
-            if not os.path.isfile(save_path):
+            weights = self.read_file(save_path)
+            if weights is None:
                 print("%s not exists yet!" % save_path)
                 return False
             else:
-                weights = torch.load(save_path, map_location=lambda storage, loc: storage)
                 try:
                     optimizer.load_state_dict(weights)
                 except:
@@ -50,62 +319,109 @@ class CkptCallback(Callback):
                 print("success load optimizer:", save_path)
         return True
 
+    def load_export(self, model, epoch):
+        '''加载导出的低精度权重，浮点参数转换为模型当前的dtype
+        :return: bool, 是否加载成功
+        '''
+        save_path = self.get_export_path(epoch)
+        obj = self.read_file(save_path)
+        if not is_packed(obj):
+            print("%s not exists yet!" % save_path)
+            return False
+        bare_model = get_bare_model(model)
+        dtypes = dict([(k, v.dtype) for k, v in bare_model.state_dict().items()])
+        weights = bare_model.remap_weights_name(unpack_weights(obj, dtypes))
+        bare_model.load_state_dict(weights, strict=self.strict)
+        print("success load export:", save_path)
+        return True
+
     @master_only
     def save_model(self, model:BaseModel, epoch):
-        #1. save optimizer
-        optimizer = model.get_optimizer()
-        if optimizer is not None:
-            save_opt_name = "%s_optimizer_%s.pth" % (epoch, self.name)
-            save_opt_path = os.path.join(self.ckpt_dir, save_opt_name)
-            torch.save(optimizer.state_dict(), save_opt_path)
-            print('save:', save_opt_path)
-
-        #2. save weights
-        save_weight_filename = "%s_weights_%s.pth" % (epoch, self.name)
-        save_weight_path = os.path.join(self.ckpt_dir, save_weight_filename)
-        torch.save(get_bare_model(model).state_dict(), save_weight_path)
-        print('save:', save_weight_path)
-
-        #3. clear old
-        if self.max_ckpts<=0: #不清除
-            return
-        # 每间隔max_time时间保存一次
+        jobs = []
+        blob_jobs, blobs = [], []
+        if self.ckpt_format == 'single':
+            ckpt = self.build_ckpt(model, epoch, -1)
+            blob_jobs, blobs = self.dedup_weights(model, ckpt)
+            jobs.append((ckpt, self.get_ckpt_path(epoch)))
+        else:
+            #1. save optimizer
+            optimizer = model.get_optimizer()
+            if optimizer is not None:
+                save_opt_name = "%s_optimizer_%s.pth" % (epoch, self.name)
+                save_opt_path = os.path.join(self.ckpt_dir, save_opt_name)
+                jobs.append((optimizer.state_dict(), save_opt_path))
+
+            #2. save weights
+            save_weight_filename = "%s_weights_%s.pth" % (epoch, self.name)
+            save_weight_path = os.path.join(self.ckpt_dir, save_weight_filename)
+            jobs.append((get_bare_model(model).state_dict(), save_weight_path))
+        # 每间隔save_per_secs永久保留一个checkpoint
+        keep = False
         if time.time() - self.last_save_time > self.save_per_secs:
             self.last_save_time = time.time()
-        else:
-            if epoch not in self.epochs:
-                self.epochs.append(epoch)
-            while len(self.epochs) > self.max_ckpts:
-                opt_name = '%s_optimizer_%s.pth'%(self.epochs[0], self.name)
-                weight_name = '%s_weights_%s.pth'%(self.epochs[0], self.name)
-                opt_path = os.path.join(self.ckpt_dir, opt_name)
-                weight_path = os.path.join(self.ckpt_dir, weight_name)
-                print(opt_path)
-                if os.path.exists(opt_path):
-                    os.remove(opt_path)
-                if os.path.exists(weight_path):
-                    os.remove(weight_path)
-                del self.epochs[0]
+            keep = True
+        #3. 导出低精度、压缩的权重，打包在写文件时执行，异步保存时不占用训练线程
+        if self.export_dtype is not None:
+            encode = lambda weights: pack_weights(weights, self.export_dtype, self.export_codec)
+            jobs.append((get_bare_model(model).state_dict(), self.get_export_path(epoch), encode))
+        files = [job[1] for job in jobs]
+        metrics = self.get_metrics(model)
+        manifest = self.get_manifest()
+        #4. 文件写完后更新manifest并清理旧的checkpoint
+        def on_done():
+            manifest.add(epoch, files, metrics, keep, blobs)
+            removed = manifest.prune(self.max_ckpts, self.keep_best)
+            for r in removed:
+                print('remove ckpt:', r)
+            if self.dedup and len(removed) > 0:
+                self.gc_blobs()
+        # blob先于引用它的文件写入
+        self.write_files(blob_jobs + jobs, on_done)
 
 
     def on_begin_train(self, model:BaseModel):
-        self.load_weights(model, self.restore_epoch)
+        if self.save_per_steps > 0 and self.load_state(model):
+            return
+        restore_epoch = self.get_restore_epoch()
+        if restore_epoch is None:
+            print("no %s checkpoint found in manifest" % self.restore_epoch)
+        elif self.load_weights(model, restore_epoch) and self.restore_epoch in ['latest', 'best'] and restore_epoch >= 0:
+            # 从manifest恢复时从下一个epoch继续，不重新训练已完成的epoch
+            builder = model.get_builder()
+            if builder is not None:
+                builder.set_resume_point(restore_epoch, -1)
         if self.save_before_train:
             self.save_model(model, -1)
         
 
 
     def on_end_train(self, model:BaseModel):
-        pass
+        if self.saver is not None:
+            self.saver.wait()
 
     def on_begin_epoch(self, model:BaseModel, epoch:int):
         pass
 
     def on_end_epoch(self, model:BaseModel, epoch:int):
         self.save_model(model, epoch)
+        if self.save_per_steps > 0:
+            self.step_save_pending = False
+            self.save_state(model, epoch, -1)
 
     def on_begin_step(self, model:BaseModel, epoch:int, step:int):
         pass
 
     def on_end_step(self, model:BaseModel, epoch:int, step:int):
-        pass
\ No newline at end of file
+        if self.save_per_steps <= 0:
+            return
+        if (step + 1) % self.save_per_steps == 0:
+            self.step_save_pending = True
+        if not self.step_save_pending:
+            return
+        builder = model.get_builder()
+        # 梯度累积未结束时不保存，避免丢失已累积的梯度；
+        # save_per_steps不是accum_steps的倍数时在之后第一个累积边界保存
+        if builder is not None and not builder.is_accum_begin():
+            return
+        self.step_save_pending = False
+        self.save_state(model, epoch, step)
\ No newline at end of file
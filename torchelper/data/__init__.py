@@ -1,2 +1,33 @@
-from .base_dataset import get_data_loader, BaseDataset
-from .dir_dataset import MultiDirDataset, DirDataset
\ No newline at end of file
+import importlib
+
+# 按需导入，避免import torchelper.data时加载cv2等依赖
+_LAZY_ATTRS = {
+    'get_data_loader': ('.base_dataset', 'get_data_loader'),
+    'BaseDataset': ('.base_dataset', 'BaseDataset'),
+    'MultiDirDataset': ('.dir_dataset', 'MultiDirDataset'),
+    'DirDataset': ('.dir_dataset', 'DirDataset'),
+    'DataPrefetcher': ('.prefetcher', 'DataPrefetcher'),
+    'DirIndex': ('.dir_index', 'DirIndex'),
+    'SampleTable': ('.sample_table', 'SampleTable'),
+    'ImageCache': ('.img_cache', 'ImageCache'),
+    'SharedImageArena': ('.shm_arena', 'SharedImageArena'),
+    'MmapDataset': ('.mmap_dataset', 'MmapDataset'),
+    'pack_dataset': ('.mmap_dataset', 'pack_dataset'),
+    'TarShardDataset': ('.tar_dataset', 'TarShardDataset'),
+    'ZipDirDataset': ('.zip_dataset', 'ZipDirDataset'),
+}
+
+__all__ = list(_LAZY_ATTRS.keys())
+
+
+def __getattr__(attr):
+    if attr not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, attr))
+    module_name, attr_name = _LAZY_ATTRS[attr]
+    value = getattr(importlib.import_module(module_name, __name__), attr_name)
+    globals()[attr] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
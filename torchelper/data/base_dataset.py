@@ -2,18 +2,75 @@ import os
 import torch
 import cv2
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torch.utils.data.distributed import DistributedSampler
-def get_data_loader(batch_size:int, dataset:Dataset, num_workers:int=0, pin_memory=True, dist:bool=True):
+from .prefetcher import DataPrefetcher
+from .img_cache import ImageCache
+from .shm_arena import SharedImageArena
+
+class ResumableDistributedSampler(DistributedSampler):
+    '''可以从epoch中间继续的DistributedSampler，直接跳过本rank已经训练过的样本，
+    不会重新读取、解码这些样本。set_epoch会把起始位置重置为0。
+    '''
+    def __init__(self, dataset, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def set_start_index(self, start_index:int):
+        '''设置本epoch从本rank的第start_index个样本开始
+        '''
+        self.start_index = min(max(0, start_index), self.num_samples)
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+def set_loader_epoch(loader, epoch:int, start_step:int=0):
+    '''设置DataLoader的sampler的epoch，并跳过本epoch前start_step个batch
+    :param loader: DataLoader或DataPrefetcher
+    :param epoch: int
+    :param start_step: int, 从第几个batch开始
+    '''
+    # IterableDataset没有sampler，由数据集自己按epoch划分和打乱
+    dataset = getattr(loader, 'dataset', None)
+    if isinstance(dataset, IterableDataset) and hasattr(dataset, 'set_epoch'):
+        dataset.set_epoch(epoch)
+        if start_step > 0 and hasattr(dataset, 'set_start_batch'):
+            dataset.set_start_batch(start_step, loader.batch_size)
+        return
+    sampler = getattr(loader, 'sampler', None)
+    if sampler is None or not hasattr(sampler, 'set_epoch'):
+        return
+    sampler.set_epoch(epoch)
+    if start_step > 0 and hasattr(sampler, 'set_start_index'):
+        sampler.set_start_index(start_step * loader.batch_size)
+def get_data_loader(batch_size:int, dataset:Dataset, num_workers:int=0, pin_memory=True, dist:bool=True, prefetch:int=0, device=None,
+                    shuffle:bool=True, drop_last:bool=True):
     '''封装DataLoader
     :param batch_size: int
     :param dataset: Dataset
     :param num_workers: int
-    :param dist: bool, 是否是分布式采集数据
+    :param dist: bool, 是否是分布式采集数据，IterableDataset(如TarShardDataset)由数据集自己划分，忽略该参数
+    :param shuffle: bool, 分布式采集时是否打乱数据
+    :param drop_last: bool, 是否丢弃最后不足一个batch的数据
+    :param prefetch: int, 后台线程预取的batch数量，<=0时不预取，直接返回DataLoader
+    :param device: torch.device, 预取时将batch拷贝到的目标设备，为None时不拷贝
+    数据集开启了图片缓存(BaseDataset.set_img_cache)且num_workers>0时，使用persistent_workers，
+    worker和其中的缓存在epoch之间保留
     '''
     sampler = None
-    if dist:
-        sampler = DistributedSampler(dataset) # 这个sampler会自动分配数据到各个gpu上
+    # IterableDataset自己在rank和worker之间划分数据，不能使用sampler
+    if dist and not isinstance(dataset, IterableDataset):
+        sampler = ResumableDistributedSampler(dataset, shuffle=shuffle) # 这个sampler会自动分配数据到各个gpu上
+    if isinstance(dataset, IterableDataset) and hasattr(dataset, 'set_batch_size'):
+        dataset.set_batch_size(batch_size)
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=batch_size,
@@ -21,11 +78,62 @@ def get_data_loader(batch_size:int, dataset:Dataset, num_workers:int=0, pin_memo
         num_workers=num_workers,
         pin_memory=pin_memory,
         sampler=sampler,
-        drop_last=True,   # 多余的部分去除
+        drop_last=drop_last,   # 多余的部分去除
+        persistent_workers=num_workers > 0 and getattr(dataset, 'img_cache', None) is not None,
     )
+    if prefetch > 0:
+        dataloader = DataPrefetcher(dataloader, prefetch, device)
     return dataloader
 
 class BaseDataset(Dataset):
+    img_cache = None
+    shm_arena = None
+
+    def set_shm_arena(self, dst_wh):
+        '''开启节点内共享的图片缓存：所有rank和worker共用一块/dev/shm内存，每个样本只解码一次，
+        需要固定的dst_wh，len(self)*h*w*3字节需要能放进共享内存。load_img返回的是拷贝，可以原地修改
+        :param dst_wh: int或[w, h]
+        '''
+        if dst_wh is None:
+            raise ValueError('shared memory image cache requires dst_wh')
+        self.shm_arena = SharedImageArena.for_dataset(self, dst_wh)
+
+    def set_img_cache(self, max_bytes:int):
+        '''开启解码、缩放后图片的LRU缓存，max_bytes<=0时关闭，
+        每个worker进程各自缓存最多max_bytes字节
+        '''
+        self.img_cache = ImageCache(max_bytes) if max_bytes > 0 else None
+
+    def get_img_cache_stats(self):
+        '''图片缓存的命中统计，未开启缓存时返回None
+        '''
+        return self.img_cache.stats() if self.img_cache is not None else None
+
+    def load_img(self, path, dst_wh=None, is_rgb:bool=True, index:int=None):
+        '''读取图片并缩放到dst_wh，开启缓存时优先从缓存读取
+        :param dst_wh: int或[w, h], 为None时不缩放
+        :param index: int, 样本下标，开启共享内存缓存时使用
+        :return: np.ndarray, dtype=np.uint8
+        '''
+        arena = self.shm_arena
+        if arena is not None and index is not None:
+            img = arena.get(index)
+            if img is None:
+                img = arena.put(index, self.load_img(path, dst_wh, is_rgb))
+            # 共享内存中的图片是只读的，与其他路径一样返回可写的拷贝，拷贝远比解码快
+            return img.copy() if img is not None else None
+        cache = self.img_cache
+        if cache is not None:
+            img = cache.get(path)
+            if img is not None:
+                # 后续处理可能原地修改图片，返回拷贝
+                return img.copy()
+        img = self.resize(self.imread(path, is_rgb), dst_wh)
+        if cache is not None and img is not None:
+            cache.put(path, img)
+            img = img.copy()
+        return img
+
     def imread(self, path, is_rgb:bool=True):
         '''读取图片数据
         :param is_rgb: bool, 返回格式是否是rgb
@@ -40,6 +148,33 @@ class BaseDataset(Dataset):
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         return img
 
+    def imdecode(self, buf, is_rgb:bool=True):
+        '''解码内存中的图片文件数据
+        :param buf: np.ndarray(dtype=np.uint8)或bytes, 编码后的图片
+        :param is_rgb: bool, 返回格式是否是rgb
+        :return: np.ndarray, dtype=np.uint8,返回图片数据
+        '''
+        if isinstance(buf, (bytes, bytearray, memoryview)):
+            buf = np.frombuffer(buf, dtype=np.uint8)
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        #取前3个通道
+        img = img[:, :, 0:3]
+        if is_rgb:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return img
+
+    def resize(self, img, dst_wh):
+        '''缩放到dst_wh
+        :param dst_wh: int或[w, h], 为None时不缩放
+        '''
+        if img is None or dst_wh is None:
+            return img
+        if isinstance(dst_wh, list):
+            return cv2.resize(img, dst_wh)
+        return cv2.resize(img, (dst_wh, dst_wh))
+
     def imwrite(self, img, path, is_rgb:bool=True):
         if is_rgb:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -1,11 +1,22 @@
 
 import os
-import cv2
+import torch.distributed as dist
 from abc import ABCMeta, abstractmethod
 from .base_dataset import BaseDataset
+from .dir_index import DirIndex, list_dir, get_index_cache_dir
+from .sample_table import SampleTable, LabelView
+from torchelper.utils.dist_util import get_rank, broadcast_call
+
+def is_broadcast_index(cfg):
+    '''cfg['broadcast_index']为True且已初始化进程组时，只在rank0上建立样本索引，再广播给其他rank
+    '''
+    if cfg is None or not cfg.get('broadcast_index', False):
+        return False
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
 
 class DirDataset(BaseDataset):
-    '''单目录数据读取
+    '''单目录数据读取，cfg['broadcast_index']为True时只在rank0上列目录、解析label，再广播给其他rank
     '''
     def __init__(self, dir_path, dst_wh=None, img_dir=None, label_name=None, cfg=None):
         self.data_root = dir_path
@@ -16,28 +27,45 @@ class DirDataset(BaseDataset):
         self.labels = {}
         self.load_data()
         self.size = len(self.names)
+        # cfg['img_cache_mb']>0时缓存解码、缩放后的图片
+        self.set_img_cache(int(cfg.get('img_cache_mb', 0) * 1024 * 1024) if cfg is not None else 0)
+        # cfg['shm_cache']为True时同一节点的所有rank和worker共享解码后的图片
+        if cfg is not None and cfg.get('shm_cache', False):
+            self.set_shm_arena(dst_wh)
 
     def load_data(self):
+        if not is_broadcast_index(self.cfg):
+            self.build_index()
+            return
+        def build():
+            self.build_index()
+            return {'data_root': self.data_root, 'names': self.names, 'labels': self.labels}
+        # rank0建立索引失败时所有rank都抛出异常
+        state = broadcast_call(build)
+        self.data_root, self.names, self.labels = state['data_root'], state['names'], state['labels']
+
+    def build_index(self):
+        if not os.path.isdir(self.data_root):
+            raise FileNotFoundError(self.data_root)
         #加载label
         if self.label_name is not None:
             self.labels = self.parse_label(os.path.join(self.data_root , self.label_name))
         if self.img_dir is not None:
             self.data_root = os.path.join(self.data_root, self.img_dir)
-        self.names = sorted(os.listdir(self.data_root))
+        # 文件列表缓存在index_cache_dir下，目录mtime不变时不重新列目录
+        self.names = list_dir(self.data_root, cache_dir=get_index_cache_dir(self.cfg))
 
     def process_img(self, name, img, label):
         return name, img, label
 
+    def get_label(self, index):
+        return self.labels.get(self.names[index], None)
+
     def __getitem__(self, index):
         name = self.names[index]
-        label = self.labels.get(name, None)
+        label = self.get_label(index)
         img_path = os.path.join(self.data_root,  name)
-        img = self.imread(img_path)
-        if self.dst_wh is not None:
-            if isinstance(self.dst_wh, list):
-                img = cv2.resize(img, self.dst_wh)
-            else:
-                img = cv2.resize(img, (self.dst_wh, self.dst_wh))
+        img = self.load_img(img_path, self.dst_wh, index=index)
         return self.process_img(name, img, label)
 
     def __len__(self):
@@ -45,7 +73,11 @@ class DirDataset(BaseDataset):
 
 
 class MultiDirDataset(BaseDataset, metaclass=ABCMeta):
-    '''多目录读取
+    '''多目录读取，样本路径和label保存在SampleTable中(self.names)，
+    self.names[i]为'目录/图片名'，label通过self.names.get_label(i)获取；
+    self.labels是只读的LabelView，可以像原来的dict一样用self.labels.get('目录/图片名')查找。
+    cfg['broadcast_index']为True时只在rank0上列目录、调用parse_label，SampleTable的数组按桶广播给其他rank，
+    启动耗时不随rank数增加
     '''
 
     def __init__(self, root_dir_path, sub_dirs=None, img_dir=None, label_name=None, dst_wh=None, cfg=None):
@@ -56,31 +88,53 @@ class MultiDirDataset(BaseDataset, metaclass=ABCMeta):
         self.cfg = cfg
         self.dst_wh = dst_wh
         self.labels = {}
-        self.names = []
+        self.names = SampleTable()
         self.load_data()
         self.size = len(self.names)
+        # cfg['img_cache_mb']>0时缓存解码、缩放后的图片
+        self.set_img_cache(int(cfg.get('img_cache_mb', 0) * 1024 * 1024) if cfg is not None else 0)
+        # cfg['shm_cache']为True时同一节点的所有rank和worker共享解码后的图片
+        if cfg is not None and cfg.get('shm_cache', False):
+            self.set_shm_arena(dst_wh)
 
     def load_data(self):
+        if not is_broadcast_index(self.cfg):
+            self.build_index()
+            return
+        def build():
+            self.build_index()
+            return self.names.state_dict()
+        # rank0建立索引失败时所有rank都抛出异常
+        state = broadcast_call(build)
+        if get_rank() != 0:
+            self.names.load_state_dict(state)
+            self.labels = LabelView(self.names)
+
+    def build_index(self):
+        if not os.path.isdir(self.data_root):
+            raise FileNotFoundError(self.data_root)
+        # 文件列表缓存在index_cache_dir下，只重新扫描mtime变化了的目录
+        index = DirIndex(self.data_root, get_index_cache_dir(self.cfg))
         if self.sub_dirs is None:
-            dirs = os.listdir(self.data_root)
+            dirs = index.scan([''])['']['dirs']
         else:
-            dirs = self.sub_dirs
-        for dir in dirs:
+            dirs = [dir for dir in self.sub_dirs if os.path.isdir(os.path.join(self.data_root, dir))]
+        #判断目录下是否有图片子目录
+        pre_names = [dir if self.img_dir is None else dir + '/' + self.img_dir for dir in dirs]
+        listing = index.scan(pre_names)
+        index.save()
+        for dir, pre_name in zip(dirs, pre_names):
             dir_path = os.path.join(self.data_root, dir)
-            if not os.path.isdir(dir_path):
-                continue
-            pre_name, img_dir = dir, dir_path
-            #判断目录下是否有图片子目录
-            if self.img_dir is not None:
-                img_dir = os.path.join(img_dir, self.img_dir)
-                pre_name = pre_name + '/' + self.img_dir
+            if listing[pre_name] is None:
+                raise FileNotFoundError(os.path.join(self.data_root, pre_name))
             #获取图片子目录+名称
-            for name in os.listdir(img_dir):
-                if self.is_img_name(name):
-                    self.names.append(pre_name + '/' + name)
+            self.names.add_dir(pre_name, [name for name in listing[pre_name]['names'] if self.is_img_name(name)])
             #加载label
             if self.label_name is not None:
                 self.labels = self.parse_label(self.labels, dir, os.path.join(dir_path, self.label_name))
+        # label转换为数组后释放dict
+        self.names.finalize(self.labels)
+        self.labels = LabelView(self.names)
 
 
     @abstractmethod
@@ -90,25 +144,23 @@ class MultiDirDataset(BaseDataset, metaclass=ABCMeta):
                 因为根目录是通用的，为了节约空间，省去根目录。
         :param dir_name: 目录名称
         :param label_path: label路径
-        :return: dict, 返回更新后的字典
+        :return: dict, 返回更新后的字典，所有目录加载完后会转换为SampleTable中的数组
         '''
         return label_dict
 
     def process_img(self, name, img, label):
         return name, img, label
 
+    def get_label(self, index):
+        return self.names.get_label(index)
+
     def __getitem__(self, index):
 
         name = self.names[index]
-        label = self.labels.get(name, None)
+        label = self.get_label(index)
         img_path = os.path.join(self.data_root,  name)
         # img is RGB
-        img = self.imread(img_path)
-        if self.dst_wh is not None:
-            if isinstance(self.dst_wh, list):
-                img = cv2.resize(img, self.dst_wh)
-            else:
-                img = cv2.resize(img, (self.dst_wh, self.dst_wh))
+        img = self.load_img(img_path, self.dst_wh, index=index)
         return self.process_img(name, img, label)
 
     def __len__(self):
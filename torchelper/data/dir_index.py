@@ -0,0 +1,135 @@
+'''目录文件列表的磁盘缓存
+'''
+import os
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'torchelper', 'dir_index')
+
+
+def get_index_cache_dir(cfg):
+    '''从cfg中读取index_cache_dir，未配置时使用~/.cache/torchelper/dir_index，配置为None时不缓存
+    '''
+    if cfg is None:
+        return DEFAULT_CACHE_DIR
+    return cfg.get('index_cache_dir', DEFAULT_CACHE_DIR)
+
+
+def scan_dir(path:str):
+    '''用os.scandir列出目录，目录不存在时返回None
+    :return: dict, {'mtime': int, 'names': 排序后的全部名称, 'dirs': 排序后的子目录名称}
+    '''
+    try:
+        # 先取mtime再列目录，列目录期间发生的修改会在下次加载时被发现
+        mtime = os.stat(path).st_mtime_ns
+        names, dirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                except OSError:
+                    pass
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return {'mtime': mtime, 'names': sorted(names), 'dirs': sorted(dirs)}
+
+
+class DirIndex():
+    '''root下各目录的文件列表缓存，按root的绝对路径保存在cache_dir下，每个目录记录mtime，
+    加载时只重新扫描mtime变化了的目录，stat和扫描都用线程池并行执行（网络存储上单次请求延迟高）。
+
+    示例:
+    ```python
+    index = DirIndex('/data/faces', cache_dir='~/.cache/torchelper/dir_index')
+    listing = index.scan(['', 'a/imgs', 'b/imgs'])
+    names = listing['a/imgs']['names']
+    index.save()
+    ```
+    Args:
+        root: str, 数据根目录
+        cache_dir: str, 缓存目录，为None时不读写缓存文件，只做并行扫描
+        num_threads: int, 并行stat/扫描的线程数
+    '''
+    def __init__(self, root:str, cache_dir:str=None, num_threads:int=16):
+        self.root = os.path.abspath(root)
+        self.num_threads = max(1, num_threads)
+        self.path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+            self.path = os.path.join(os.path.expanduser(cache_dir), 'dir_index_%s.pkl' % key)
+        self.dirs = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print('failed to load dir index %s: %s' % (self.path, e))
+            return
+        if data.get('root', None) == self.root:
+            self.dirs = data['dirs']
+
+    def save(self):
+        '''有目录被重新扫描时原子地写回缓存文件
+        '''
+        if self.path is None or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 多个进程可能同时写，临时文件名带上pid
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'root': self.root, 'dirs': self.dirs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def _refresh(self, rel_dir:str):
+        path = os.path.join(self.root, rel_dir)
+        cached = self.dirs.get(rel_dir, None)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if cached is not None and cached['mtime'] == mtime:
+            return cached
+        return scan_dir(path)
+
+    def scan(self, rel_dirs:list):
+        '''获取多个目录的文件列表，过期的目录重新扫描
+        :param rel_dirs: list, 相对root的目录，''表示root本身
+        :return: dict, {rel_dir: scan_dir的结果}，不存在的目录为None
+        '''
+        rel_dirs = list(rel_dirs)
+        if len(rel_dirs) <= 1:
+            results = [self._refresh(d) for d in rel_dirs]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.num_threads, len(rel_dirs))) as executor:
+                results = list(executor.map(self._refresh, rel_dirs))
+        listing = {}
+        for rel_dir, res in zip(rel_dirs, results):
+            if res is None:
+                if rel_dir in self.dirs:
+                    del self.dirs[rel_dir]
+                    self.dirty = True
+            elif self.dirs.get(rel_dir, None) is not res:
+                self.dirs[rel_dir] = res
+                self.dirty = True
+            listing[rel_dir] = res
+        return listing
+
+
+def list_dir(root:str, rel_dir:str='', cache_dir:str=None):
+    '''带缓存的sorted(os.listdir(os.path.join(root, rel_dir)))
+    '''
+    index = DirIndex(root, cache_dir)
+    res = index.scan([rel_dir])[rel_dir]
+    if res is None:
+        raise FileNotFoundError(os.path.join(root, rel_dir))
+    index.save()
+    return res['names']
@@ -0,0 +1,66 @@
+'''解码后图片的LRU缓存
+'''
+import multiprocessing as mp
+from collections import OrderedDict
+
+
+class ImageCache():
+    '''按字节数限制大小的LRU缓存，保存解码、缩放后的uint8图片。
+
+    每个DataLoader worker进程各自持有一份缓存（需要persistent_workers，否则每个epoch都会重建worker），
+    命中/未命中计数保存在共享内存中，主进程可以直接读取所有worker的统计。
+
+    示例:
+    ```python
+    cache = ImageCache(2 * 1024**3)
+    img = cache.get(path)
+    if img is None:
+        img = decode(path)
+        cache.put(path, img)
+    cache.stats()  # {'hits': ..., 'misses': ..., 'hit_rate': ...}
+    ```
+    Args:
+        max_bytes: int, 每个进程缓存的最大字节数
+    '''
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        # hits, misses
+        self.counters = mp.Array('q', 2)
+
+    def _count(self, i):
+        with self.counters.get_lock():
+            self.counters[i] += 1
+
+    def get(self, key):
+        '''返回缓存的图片(只读)，不存在时返回None
+        '''
+        img = self.items.get(key, None)
+        if img is None:
+            self._count(1)
+            return None
+        self.items.move_to_end(key)
+        self._count(0)
+        return img
+
+    def put(self, key, img):
+        if img is None or img.nbytes > self.max_bytes:
+            return
+        if key in self.items:
+            self.nbytes -= self.items.pop(key).nbytes
+        img.setflags(write=False)
+        self.items[key] = img
+        self.nbytes += img.nbytes
+        while self.nbytes > self.max_bytes:
+            __, old = self.items.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def stats(self):
+        '''所有进程的命中统计，以及当前进程缓存的图片数和字节数
+        '''
+        with self.counters.get_lock():
+            hits, misses = self.counters[0], self.counters[1]
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total > 0 else 0.0,
+                'entries': len(self.items), 'bytes': self.nbytes}
@@ -0,0 +1,144 @@
+'''把目录数据集打包成少量大文件，训练时用np.memmap读取
+'''
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .base_dataset import BaseDataset
+from .sample_table import SampleTable
+
+# 每个样本的定长索引
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('nbytes', '<i8'), ('h', '<i4'), ('w', '<i4'), ('c', '<i4')])
+
+
+def _build_table(dataset):
+    names = dataset.names
+    if isinstance(names, SampleTable):
+        return names
+    table = SampleTable()
+    table.add_dir('', list(names))
+    labels = {}
+    for i in range(len(names)):
+        label = dataset.get_label(i)
+        if label is not None:
+            labels[names[i]] = label
+    return table.finalize(labels)
+
+
+def pack_dataset(dataset, out_dir:str, shard_mb:int=1024, decode:bool=False, num_threads:int=16, chunk_size:int=1024):
+    '''把DirDataset/MultiDirDataset打包到out_dir：
+    shard_xxxxx.bin为按样本顺序拼接的图片数据，index.npy为定长索引(INDEX_DTYPE)，
+    table.npz为样本名称和label(SampleTable)，meta.json记录格式
+    :param dataset: DirDataset/MultiDirDataset
+    :param out_dir: str, 输出目录
+    :param shard_mb: int, 每个shard文件的最大大小(MB)
+    :param decode: bool, True时保存解码并缩放到dataset.dst_wh后的uint8像素，读取时不需要解码；
+        False时保存原始的图片文件
+    :param num_threads: int, 并行读取/解码的线程数
+    :param chunk_size: int, 每批并行读取的样本数
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    shard_bytes = shard_mb * 1024 * 1024
+    num = len(dataset)
+    index = np.zeros(num, dtype=INDEX_DTYPE)
+
+    def read(i):
+        path = os.path.join(dataset.data_root, dataset.names[i])
+        if decode:
+            img = dataset.resize(dataset.imread(path), dataset.dst_wh)
+            if img is None:
+                raise ValueError('failed to read image: ' + path)
+            return np.ascontiguousarray(img).tobytes(), img.shape
+        with open(path, 'rb') as f:
+            return f.read(), (0, 0, 0)
+
+    shard_id, shard_size, f = 0, 0, None
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        for start in range(0, num, chunk_size):
+            for i, (data, shape) in enumerate(executor.map(read, range(start, min(num, start + chunk_size))), start):
+                if f is None or (shard_size > 0 and shard_size + len(data) > shard_bytes):
+                    if f is not None:
+                        f.close()
+                        shard_id += 1
+                    f = open(os.path.join(out_dir, 'shard_%05d.bin' % shard_id), 'wb')
+                    shard_size = 0
+                index[i] = (shard_id, shard_size, len(data)) + tuple(shape)
+                f.write(data)
+                shard_size += len(data)
+    if f is not None:
+        f.close()
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    _build_table(dataset).save(os.path.join(out_dir, 'table.npz'))
+    meta = {'format': 'raw' if decode else 'encoded', 'num_samples': num,
+            'num_shards': shard_id + 1 if num > 0 else 0}
+    with open(os.path.join(out_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class MmapDataset(BaseDataset):
+    '''读取pack_dataset打包的数据，shard文件用np.memmap映射，样本是文件中的一段连续数据，
+    不需要逐个打开小文件。raw格式从映射的像素拷贝一份返回，encoded格式在内存中解码，返回的图片都可以原地修改。
+
+    示例:
+    ```python
+    pack_dataset(MyMultiDirDataset(cfg), '/data/packed', decode=False)
+    dataset = MmapDataset('/data/packed', dst_wh=256)
+    name, img, label = dataset[0]
+    ```
+    Args:
+        pack_dir: str, pack_dataset的输出目录
+        dst_wh: int或[w, h], 缩放尺寸，为None时不缩放
+        cfg: dict
+    '''
+    def __init__(self, pack_dir, dst_wh=None, cfg=None):
+        self.data_root = pack_dir
+        self.dst_wh = dst_wh
+        self.cfg = cfg
+        with open(os.path.join(pack_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(pack_dir, 'index.npy'), mmap_mode='r')
+        self.names = SampleTable.load(os.path.join(pack_dir, 'table.npz'))
+        self.size = len(self.index)
+        # 每个进程第一次读取时再打开，fork/spawn出的worker各自映射
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, shard_id:int):
+        shard = self.shards.get(shard_id, None)
+        if shard is None:
+            shard = np.memmap(os.path.join(self.data_root, 'shard_%05d.bin' % shard_id), dtype=np.uint8, mode='r')
+            self.shards[shard_id] = shard
+        return shard
+
+    def get_label(self, index):
+        return self.names.get_label(index)
+
+    def process_img(self, name, img, label):
+        return name, img, label
+
+    def __getitem__(self, index):
+        rec = self.index[index]
+        offset, nbytes = int(rec['offset']), int(rec['nbytes'])
+        buf = self.get_shard(int(rec['shard']))[offset:offset + nbytes]
+        if self.meta['format'] == 'raw':
+            shape = (int(rec['h']), int(rec['w']), int(rec['c']))
+            img = buf.reshape(shape)
+            if self.dst_wh is not None:
+                w, h = self.dst_wh if isinstance(self.dst_wh, list) else (self.dst_wh, self.dst_wh)
+                # 打包时已经缩放过，尺寸一致时不缩放
+                if img.shape[:2] != (h, w):
+                    img = self.resize(img, self.dst_wh)
+            # 映射的数据只读，拷贝一份，避免原地增强和default_collate出错
+            if not img.flags.writeable:
+                img = np.array(img)
+        else:
+            img = self.resize(self.imdecode(buf), self.dst_wh)
+        return self.process_img(self.names[index], img, self.get_label(index))
+
+    def __len__(self):
+        return self.size
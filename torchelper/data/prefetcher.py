@@ -0,0 +1,130 @@
+import queue
+import threading
+import torch
+
+
+def move_to_device(data, device, non_blocking=False):
+    '''递归地将batch中的tensor拷贝到指定设备，非tensor数据原样返回
+    :param data: tensor/list/tuple/dict, DataLoader返回的batch
+    :param device: torch.device, 目标设备
+    :param non_blocking: bool, 是否异步拷贝（仅对pin memory的数据有效）
+    :return: 拷贝后的batch
+    '''
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {k: move_to_device(v, device, non_blocking) for k, v in data.items()}
+    if isinstance(data, tuple) and hasattr(data, '_fields'): # namedtuple
+        return type(data)(*[move_to_device(v, device, non_blocking) for v in data])
+    if isinstance(data, (list, tuple)):
+        return type(data)([move_to_device(v, device, non_blocking) for v in data])
+    return data
+
+
+def record_stream(data, stream):
+    '''标记batch中的cuda tensor被stream使用，避免拷贝stream上的显存被提前复用
+    '''
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            record_stream(v, stream)
+
+
+class DataPrefetcher():
+    '''后台线程预取DataLoader的batch，并提前拷贝到目标设备，
+    使数据读取/解码与训练的前向、反向计算重叠。
+
+    示例:
+    ```python
+    loader = get_data_loader(8, dataset, num_workers=4, prefetch=2, device=torch.device('cuda:0'))
+    for i, data in enumerate(loader):
+        ...
+    ```
+    Args:
+        loader: DataLoader, 被封装的DataLoader
+        prefetch: int, 队列中最多缓存的batch数量
+        device: torch.device, 目标设备，为None时不做拷贝
+    '''
+    def __init__(self, loader, prefetch:int=2, device=None):
+        self.loader = loader
+        self.prefetch = max(1, prefetch)
+        self.device = torch.device(device) if device is not None else None
+        self.non_blocking = bool(getattr(loader, 'pin_memory', False))
+        self.stream = None
+        if self.device is not None and self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _load(self, data_queue:queue.Queue, stop_event:threading.Event):
+        '''后台线程：读取batch -> 拷贝到设备 -> 放入队列
+        '''
+        try:
+            if self.stream is not None:
+                torch.cuda.set_device(self.device)
+            for data in self.loader:
+                event = None
+                if self.device is not None:
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            data = move_to_device(data, self.device, self.non_blocking)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        data = move_to_device(data, self.device)
+                if not self._put(data_queue, stop_event, (data, event, None)):
+                    return
+        except Exception as e: # 异常转交给训练线程抛出
+            self._put(data_queue, stop_event, (None, None, e))
+            return
+        self._put(data_queue, stop_event, None)
+
+    def _put(self, data_queue:queue.Queue, stop_event:threading.Event, item):
+        while not stop_event.is_set():
+            try:
+                data_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        data_queue = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._load, args=(data_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = data_queue.get()
+                if item is None:
+                    break
+                data, event, error = item
+                if error is not None:
+                    raise error
+                if event is not None:
+                    cur_stream = torch.cuda.current_stream(self.device)
+                    cur_stream.wait_event(event)
+                    record_stream(data, cur_stream)
+                yield data
+        finally:
+            # 提前退出循环（break/异常）时结束后台线程
+            stop_event.set()
+            thread.join()
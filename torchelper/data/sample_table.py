@@ -0,0 +1,223 @@
+'''紧凑的样本表：用numpy数组保存样本路径和label
+'''
+import pickle
+from collections.abc import Mapping
+import numpy as np
+import torch
+
+
+class SampleTable():
+    '''样本路径和label的紧凑存储，代替python的list和dict。
+
+    路径拆分为目录编号(int32数组)和文件名，文件名用utf-8编码后拼接成一个字节数组，另存一个偏移数组；
+    label都是同一类型的数值(int/float/bool或numpy标量)，或dtype和形状都相同的numpy数组时保存为一个numpy数组，
+    get_label返回原来的类型；否则(如list、str、混合类型)逐个pickle后同样拼接保存。
+    所有数据都在少数几个numpy数组中，DataLoader的worker fork之后读取时不会修改引用计数，
+    因此不会触发写时复制，内存不会随worker数和epoch增长。
+
+    示例:
+    ```python
+    table = SampleTable()
+    table.add_dir('a/imgs', ['1.png', '2.png'])
+    table.add_dir('b/imgs', ['3.png'])
+    table.finalize({'a/imgs/1.png': 0, 'b/imgs/3.png': 1})
+    table[0]              # 'a/imgs/1.png'
+    table.get_label(1)    # None
+    ```
+    '''
+    def __init__(self):
+        self.dirs = []
+        self.dir_ids = None
+        self.name_buf = None
+        self.name_offsets = None
+        self.label_index = None
+        self.label_array = None
+        # label_array中保存的是python数值时不为None，get_label转换回python类型
+        self.label_py = None
+        self.label_buf = None
+        self.label_offsets = None
+        # 构建时的临时数据，finalize后释放
+        self._chunks = []
+        self._lengths = []
+        self._ids = []
+
+    def add_dir(self, pre_name:str, names:list):
+        '''添加一个目录下的样本
+        :param pre_name: str, 目录(相对数据根目录)，''表示根目录
+        :param names: list, 文件名
+        '''
+        encoded = [name.encode('utf-8') for name in names]
+        self._chunks.append(b''.join(encoded))
+        self._lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        self._ids.append(np.full(len(encoded), len(self.dirs), dtype=np.int32))
+        self.dirs.append(pre_name)
+
+    def finalize(self, labels:dict=None):
+        '''合并添加的目录，并把labels转换为数组
+        :param labels: dict, {'目录/文件名': label}
+        '''
+        lengths = np.concatenate(self._lengths) if len(self._lengths) > 0 else np.zeros(0, dtype=np.int64)
+        self.name_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.name_offsets[1:])
+        self.name_buf = np.frombuffer(b''.join(self._chunks), dtype=np.uint8)
+        self.dir_ids = np.concatenate(self._ids) if len(self._ids) > 0 else np.zeros(0, dtype=np.int32)
+        self._chunks, self._lengths, self._ids = [], [], []
+        self.set_labels(labels)
+        return self
+
+    @staticmethod
+    def _label_array(values:list):
+        '''values能无损地保存为数值数组时返回(数组, 是否是python数值)，否则返回(None, False)
+        '''
+        types = set([type(v) for v in values])
+        if len(types) != 1:
+            return None, False
+        t = types.pop()
+        if t in (bool, int, float):
+            try:
+                return np.asarray(values), True
+            except OverflowError: # 超出int64的整数
+                return None, False
+        if issubclass(t, np.generic) and np.dtype(t).kind in 'biuf':
+            return np.asarray(values), False
+        if t is np.ndarray and values[0].dtype.kind in 'biuf' and \
+                all([v.dtype == values[0].dtype and v.shape == values[0].shape for v in values]):
+            return np.stack(values), False
+        return None, False
+
+    def set_labels(self, labels:dict):
+        self.label_index = np.full(len(self), -1, dtype=np.int64)
+        self.label_array, self.label_py, self.label_buf, self.label_offsets = None, None, None, None
+        if labels is None or len(labels) == 0:
+            return
+        values = []
+        for i in range(len(self)):
+            label = labels.get(self[i], None)
+            if label is not None:
+                self.label_index[i] = len(values)
+                values.append(label)
+        array, is_py = self._label_array(values)
+        if array is not None:
+            self.label_array = array
+            self.label_py = np.ones(1, dtype=np.bool_) if is_py else None
+            return
+        encoded = [pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL) for v in values]
+        self.label_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=self.label_offsets[1:])
+        self.label_buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return 0 if self.dir_ids is None else len(self.dir_ids)
+
+    def get_name(self, index:int):
+        '''文件名，不含目录
+        '''
+        return self.name_buf[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index:int):
+        dir_name = self.dirs[self.dir_ids[index]]
+        if len(dir_name) == 0:
+            return self.get_name(index)
+        return dir_name + '/' + self.get_name(index)
+
+    def get_label(self, index:int):
+        '''第index个样本的label，没有时返回None
+        '''
+        if self.label_index is None:
+            return None
+        i = self.label_index[index]
+        if i < 0:
+            return None
+        if self.label_array is not None:
+            value = self.label_array[i]
+            return value.item() if self.label_py is not None else value
+        return pickle.loads(self.label_buf[self.label_offsets[i]:self.label_offsets[i + 1]].tobytes())
+
+    def arrays(self):
+        return {
+            'dir_ids': self.dir_ids,
+            'name_buf': self.name_buf,
+            'name_offsets': self.name_offsets,
+            'label_index': self.label_index,
+            'label_array': self.label_array,
+            'label_py': self.label_py,
+            'label_buf': self.label_buf,
+            'label_offsets': self.label_offsets,
+        }
+
+    def nbytes(self):
+        '''所有数组占用的字节数
+        '''
+        return sum([a.nbytes for a in self.arrays().values() if a is not None])
+
+    def state_dict(self):
+        '''转换为可以用broadcast_state广播的dict，数组按字节转为uint8 tensor
+        '''
+        state = {'dirs': self.dirs, 'arrays': {}}
+        for k, a in self.arrays().items():
+            if a is None:
+                continue
+            a = np.ascontiguousarray(a)
+            data = a.reshape(-1).view(np.uint8)
+            if not data.flags.writeable: # np.frombuffer得到的数组只读，torch.from_numpy会警告
+                data = data.copy()
+            state['arrays'][k] = {'dtype': a.dtype.str, 'shape': a.shape, 'data': torch.from_numpy(data)}
+        return state
+
+    def load_state_dict(self, state:dict):
+        self.dirs = state['dirs']
+        for k in self.arrays().keys():
+            a = state['arrays'].get(k, None)
+            if a is not None:
+                a = a['data'].numpy().view(np.dtype(a['dtype'])).reshape(a['shape'])
+            setattr(self, k, a)
+        return self
+
+    def save(self, path, **extra):
+        '''保存为npz文件
+        :param path: str或文件对象
+        :param extra: 一起保存的其他数组
+        '''
+        arrays = dict([(k, a) for k, a in self.arrays().items() if a is not None])
+        arrays.update(extra)
+        np.savez(path, dirs=np.array(self.dirs, dtype=np.str_), **arrays)
+
+    @staticmethod
+    def load(path:str):
+        table = SampleTable()
+        with np.load(path) as data:
+            table.dirs = [str(d) for d in data['dirs']]
+            for k in table.arrays().keys():
+                if k in data.files:
+                    setattr(table, k, data[k])
+        return table
+
+
+class LabelView(Mapping):
+    '''SampleTable中label的只读dict视图，{'目录/文件名': label}，只包含有label的样本。
+    按名称查找时才建立名称到编号的dict
+    '''
+    def __init__(self, table:SampleTable):
+        self.table = table
+        self._index = None
+
+    def _name_index(self):
+        if self._index is None:
+            self._index = dict([(self.table[i], i) for i in self._labeled()])
+        return self._index
+
+    def _labeled(self):
+        if self.table.label_index is None:
+            return []
+        return np.nonzero(self.table.label_index >= 0)[0].tolist()
+
+    def __getitem__(self, name:str):
+        return self.table.get_label(self._name_index()[name])
+
+    def __iter__(self):
+        return (self.table[i] for i in self._labeled())
+
+    def __len__(self):
+        if self.table.label_index is None:
+            return 0
+        return int(np.count_nonzero(self.table.label_index >= 0))
@@ -0,0 +1,149 @@
+'''节点内所有进程共享的图片内存区
+'''
+import os
+import time
+import atexit
+import hashlib
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+_MAGIC = 0x54484152454e41  # 'THARENA'
+_HEADER_SIZE = 64
+
+
+def _unregister(shm):
+    '''attach的进程不负责删除共享内存，从resource_tracker中移除，避免进程退出时被unlink
+    '''
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _attach(name:str, size:int, timeout:float=60.0):
+    '''attach已存在的共享内存，创建的进程可能还没有设置好大小，等待其完成
+    '''
+    start = time.time()
+    while True:
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=False)
+        except ValueError: # 大小为0，无法mmap
+            shm = None
+        if shm is not None and shm.size >= size:
+            _unregister(shm)
+            return shm
+        if shm is not None:
+            _unregister(shm)
+            shm.close()
+        if time.time() - start > timeout:
+            raise ValueError('shared memory %s is smaller than expected' % name)
+        time.sleep(0.01)
+
+
+class SharedImageArena():
+    '''按样本下标保存固定尺寸uint8图片的共享内存(/dev/shm)，同一节点上所有rank和DataLoader worker共用一份。
+
+    内存布局：64字节头部(magic, num_samples, h, w, c)，每个样本1字节的填充标记，之后是num_samples个h*w*c的图片。
+    第一个打开的进程创建并在退出时删除，其他进程直接attach；图片在第一次读取时由读取的进程解码写入，
+    之后所有进程用np.frombuffer零拷贝读取（返回只读数组）。
+
+    示例:
+    ```python
+    arena = SharedImageArena.for_dataset(dataset, (256, 256))
+    img = arena.get(index)
+    if img is None:
+        img = arena.put(index, decode(index))
+    ```
+    Args:
+        name: str, 共享内存名称，同一节点上相同名称的进程共享
+        num_samples: int, 样本数
+        shape: tuple, (h, w, c)
+    '''
+    def __init__(self, name:str, num_samples:int, shape:tuple):
+        self.name = name
+        self.num_samples = num_samples
+        self.shape = tuple(shape)
+        self.slot_size = int(np.prod(self.shape))
+        self.data_offset = _HEADER_SIZE + (num_samples + 63) // 64 * 64
+        size = self.data_offset + self.slot_size * num_samples
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.owner = os.getpid()
+        except FileExistsError:
+            self.shm = _attach(name, size)
+            self.owner = None
+        self.header = np.frombuffer(self.shm.buf, dtype=np.int64, count=5)
+        if self.owner is not None:
+            # 新建的共享内存内容为0，所有样本都未填充
+            self.header[1:] = (num_samples,) + self.shape
+            self.header[0] = _MAGIC
+            atexit.register(self.close)
+        elif self.header[0] == _MAGIC and tuple(self.header[1:]) != (num_samples,) + self.shape:
+            raise ValueError('shared memory %s has a different layout' % name)
+        self.filled = np.frombuffer(self.shm.buf, dtype=np.uint8, count=num_samples, offset=_HEADER_SIZE)
+
+    @staticmethod
+    def for_dataset(dataset, dst_wh, channels:int=3):
+        '''按数据集生成名称并打开共享内存，名称包含父进程pid，同一次启动的rank共享，不同启动之间互不影响
+        :param dst_wh: int或[w, h]
+        '''
+        w, h = (dst_wh, dst_wh) if not isinstance(dst_wh, (list, tuple)) else dst_wh
+        key = '%s|%s|%d|%d|%d|%d' % (type(dataset).__name__, getattr(dataset, 'data_root', ''), len(dataset), w, h, os.getppid())
+        name = 'torchelper_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return SharedImageArena(name, len(dataset), (h, w, channels))
+
+    def _view(self, index:int):
+        return np.frombuffer(self.shm.buf, dtype=np.uint8, count=self.slot_size,
+                             offset=self.data_offset + index * self.slot_size).reshape(self.shape)
+
+    def get(self, index:int):
+        '''已填充时返回只读的图片，否则返回None
+        '''
+        if not self.filled[index]:
+            return None
+        img = self._view(index)
+        img.setflags(write=False)
+        return img
+
+    def put(self, index:int, img:np.ndarray):
+        '''写入图片并返回共享内存中的只读视图，尺寸不一致时不写入，返回原图
+        '''
+        if img is None or img.shape != self.shape or img.dtype != np.uint8:
+            return img
+        view = self._view(index)
+        view[...] = img
+        # 数据写完后再设置标记，多个进程同时写同一个样本时内容相同，不影响读取
+        self.filled[index] = 1
+        view.setflags(write=False)
+        return view
+
+    def num_filled(self):
+        return int(self.filled.sum())
+
+    def __getstate__(self):
+        # spawn方式启动的worker重新attach
+        return {'name': self.name, 'num_samples': self.num_samples, 'shape': self.shape}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.num_samples = state['num_samples']
+        self.shape = state['shape']
+        self.slot_size = int(np.prod(self.shape))
+        self.data_offset = _HEADER_SIZE + (self.num_samples + 63) // 64 * 64
+        self.shm = _attach(self.name, self.data_offset + self.slot_size * self.num_samples)
+        self.owner = None
+        self.header = np.frombuffer(self.shm.buf, dtype=np.int64, count=5)
+        self.filled = np.frombuffer(self.shm.buf, dtype=np.uint8, count=self.num_samples, offset=_HEADER_SIZE)
+
+    def close(self):
+        '''创建的进程退出时删除共享内存，已经attach的进程仍然可以继续读取
+        '''
+        if self.shm is None:
+            return
+        # fork出的worker继承了owner，只有创建的进程删除
+        if self.owner == os.getpid():
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = None
@@ -0,0 +1,205 @@
+'''顺序读取tar分片的IterableDataset
+'''
+import os
+import glob
+import json
+import random
+import tarfile
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from .base_dataset import BaseDataset
+
+
+def list_shards(shards):
+    '''解析分片列表
+    :param shards: list, 或目录(其中所有.tar文件)，或glob模式
+    :return: list, 排序后的tar文件路径
+    '''
+    if isinstance(shards, (list, tuple)):
+        return list(shards)
+    if os.path.isdir(shards):
+        return sorted([os.path.join(shards, name) for name in os.listdir(shards) if name.endswith('.tar')])
+    return sorted(glob.glob(shards))
+
+
+class TarShardDataset(BaseDataset, IterableDataset):
+    '''按顺序流式读取tar分片，适合机械硬盘、对象存储挂载等随机读取很慢的存储。
+
+    tar中同一样本的文件用相同的前缀命名（如a/0001.jpg、a/0001.json），图片用imdecode解码，
+    其他文件交给parse_label解析。每个epoch按seed+epoch确定性地打乱分片顺序，
+    先把分片不重叠地分给各个rank（分片数不能少于rank数），再分给本rank的DataLoader worker，
+    样本经过有限大小的缓冲区打乱后输出。get_data_loader对IterableDataset不使用DistributedSampler，
+    并调用set_batch_size；由train调用set_epoch。
+
+    指定samples_per_rank时，每个rank输出samples_per_rank // batch_size个完整的batch，按DataLoader轮流取batch的顺序
+    分给各个worker，因此每个worker内的drop_last不会丢弃样本，len(DataLoader)就是实际的batch数；
+    本rank的分片少于worker数时，worker循环复用本rank的分片。
+
+    示例:
+    ```python
+    dataset = TarShardDataset('/data/shards/*.tar', dst_wh=256, samples_per_rank=100000)
+    loader = get_data_loader(32, dataset, num_workers=4)
+    dataset.set_epoch(epoch)
+    ```
+    Args:
+        shards: list/str, tar文件列表、目录或glob模式
+        dst_wh: int或[w, h], 缩放尺寸，为None时不缩放
+        shuffle_buffer: int, 打乱缓冲区的样本数，<=1时不打乱样本
+        shuffle_shards: bool, 每个epoch是否打乱分片顺序
+        seed: int, 随机种子，所有rank需相同
+        samples_per_rank: int, 每个rank每个epoch输出的样本数(向下取整到batch_size的倍数)，分片读完后从头循环，
+            保证各rank的step数相同；为None时读完分到的分片即结束，此时没有__len__，不能用于train
+        cfg: dict
+    '''
+    def __init__(self, shards, dst_wh=None, shuffle_buffer:int=1000, shuffle_shards:bool=True, seed:int=0,
+                 samples_per_rank:int=None, cfg=None):
+        self.shards = list_shards(shards)
+        self.dst_wh = dst_wh
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_shards = shuffle_shards
+        self.seed = seed
+        self.samples_per_rank = samples_per_rank
+        self.cfg = cfg
+        self.epoch = 0
+        self.start_batch = 0
+        self.batch_size = 1
+
+    def set_epoch(self, epoch:int):
+        '''设置epoch，决定分片顺序和打乱结果，同时清除set_start_batch设置的位置
+        '''
+        self.epoch = epoch
+        self.start_batch = 0
+
+    def set_batch_size(self, batch_size:int):
+        '''DataLoader的batch_size，用于按batch把样本分给worker
+        '''
+        self.batch_size = max(1, batch_size)
+
+    def set_start_batch(self, start_batch:int, batch_size:int):
+        '''断点续训时本epoch跳过前start_batch个batch
+        '''
+        self.start_batch = max(0, start_batch)
+        self.set_batch_size(batch_size)
+
+    def parse_label(self, ext:str, data:bytes):
+        '''解析样本中的非图片文件，子类可重写
+        :param ext: str, 扩展名，如'json'、'cls'
+        :param data: bytes, 文件内容
+        '''
+        if ext == 'json':
+            return json.loads(data.decode('utf-8'))
+        if ext in ['cls', 'txt']:
+            text = data.decode('utf-8').strip()
+            return int(text) if text.lstrip('-').isdigit() else text
+        return data
+
+    def process_img(self, name, img, label):
+        return name, img, label
+
+    def _split(self):
+        '''当前rank和worker的编号
+        :return: (rank, world_size, worker_id, num_workers)
+        '''
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        return rank, world_size, worker_id, num_workers
+
+    def _worker_shards(self):
+        shards = list(self.shards)
+        if self.shuffle_shards:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        rank, world_size, worker_id, num_workers = self._split()
+        if len(shards) < world_size:
+            raise ValueError('TarShardDataset needs at least one shard per rank, got %d shards for %d ranks' % (len(shards), world_size))
+        shards = shards[rank::world_size]
+        if len(shards) >= num_workers:
+            return shards[worker_id::num_workers]
+        if self.samples_per_rank is None:
+            # 没有固定的样本数时不重复读取，多余的worker没有数据
+            return shards[worker_id:worker_id + 1]
+        # 分片少于worker数时循环复用，每个worker都能输出分到的batch
+        return [shards[worker_id % len(shards)]]
+
+    def _read_shard(self, path):
+        '''顺序读取一个tar文件，按前缀把相邻的文件组成样本
+        '''
+        key, sample = None, {}
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                dir_name, base = os.path.split(member.name)
+                if '.' not in base:
+                    continue
+                prefix, ext = base.split('.', 1)
+                member_key = os.path.join(dir_name, prefix)
+                if member_key != key and len(sample) > 0:
+                    yield key, sample
+                    sample = {}
+                key = member_key
+                sample[ext.lower()] = tar.extractfile(member).read()
+        if len(sample) > 0:
+            yield key, sample
+
+    def _decode(self, key, sample):
+        img, label = None, None
+        for ext, data in sample.items():
+            if self.is_img_name('.' + ext):
+                img = self.resize(self.imdecode(data), self.dst_wh)
+            else:
+                label = self.parse_label(ext, data)
+        return self.process_img(key, img, label)
+
+    def _samples(self, shards):
+        '''分到的分片依次读取，指定了samples_per_rank时循环读取
+        '''
+        while True:
+            for path in shards:
+                for key, sample in self._read_shard(path):
+                    yield key, sample
+            if self.samples_per_rank is None or len(shards) == 0:
+                return
+
+    def __iter__(self):
+        rank, world_size, worker_id, num_workers = self._split()
+        rng = random.Random('%d-%d-%d-%d' % (self.seed, self.epoch, rank, worker_id))
+        # DataLoader按worker顺序轮流取batch，第i个batch来自第i % num_workers个worker
+        limit = None
+        if self.samples_per_rank is not None:
+            limit = len(range(worker_id, self.samples_per_rank // self.batch_size, num_workers)) * self.batch_size
+        # 续训时跳过的样本
+        skip = len(range(worker_id, self.start_batch, num_workers)) * self.batch_size
+        buffer = []
+        count = 0
+        def emit(item):
+            # 跳过的样本不解码
+            return self._decode(*item) if count >= skip else None
+        for item in self._samples(self._worker_shards()):
+            if limit is not None and count >= limit:
+                break
+            if self.shuffle_buffer > 1:
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], item = item, buffer[i]
+            res = emit(item)
+            count += 1
+            if res is not None:
+                yield res
+        rng.shuffle(buffer)
+        for item in buffer:
+            if limit is not None and count >= limit:
+                break
+            res = emit(item)
+            count += 1
+            if res is not None:
+                yield res
+
+    def __len__(self):
+        if self.samples_per_rank is None:
+            raise TypeError('TarShardDataset without samples_per_rank has no length')
+        return max(0, self.samples_per_rank // self.batch_size - self.start_batch) * self.batch_size
@@ -0,0 +1,178 @@
+'''不解压，直接随机读取zip中图片的数据集
+'''
+import os
+import zlib
+import struct
+import hashlib
+import zipfile
+import numpy as np
+from .base_dataset import BaseDataset
+from .sample_table import SampleTable
+from .dir_index import get_index_cache_dir
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_MAGIC = b'PK\x03\x04'
+
+
+def build_zip_index(zip_path:str, is_member, cache_dir:str=None, filter_key:str=''):
+    '''解析zip的central directory，得到成员的名称和位置，按zip路径、大小、mtime和filter_key缓存到cache_dir
+    :param is_member: 判断成员名称是否需要的函数
+    :param cache_dir: str, 为None时不缓存
+    :param filter_key: str, 唯一描述is_member的字符串，不同的过滤条件使用不同的缓存
+    :return: (SampleTable, dict{'offset', 'csize', 'method'})
+    '''
+    st = os.stat(zip_path)
+    cache_path = None
+    if cache_dir is not None:
+        key = '%s|%d|%d|%s' % (os.path.abspath(zip_path), st.st_size, st.st_mtime_ns, filter_key)
+        cache_path = os.path.join(os.path.expanduser(cache_dir), 'zip_index_%s.npz' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+        if os.path.isfile(cache_path):
+            table = SampleTable.load(cache_path)
+            with np.load(cache_path) as data:
+                return table, {'offset': data['zip_offset'], 'csize': data['zip_csize'], 'method': data['zip_method']}
+
+    table = SampleTable()
+    offsets, csizes, methods = [], [], []
+    dir_name, names = None, []
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not is_member(info.filename):
+                continue
+            member_dir, name = os.path.split(info.filename)
+            # 相邻的同目录成员放在SampleTable的同一个目录下
+            if member_dir != dir_name:
+                if len(names) > 0:
+                    table.add_dir(dir_name, names)
+                dir_name, names = member_dir, []
+            names.append(name)
+            offsets.append(info.header_offset)
+            csizes.append(info.compress_size)
+            # 加密的成员不能直接解压，交给zipfile读取
+            methods.append(255 if info.flag_bits & 0x1 else info.compress_type)
+    if len(names) > 0:
+        table.add_dir(dir_name, names)
+    table.finalize()
+    index = {'offset': np.array(offsets, dtype=np.int64), 'csize': np.array(csizes, dtype=np.int64),
+             'method': np.array(methods, dtype=np.uint8)}
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            table.save(f, zip_offset=index['offset'], zip_csize=index['csize'], zip_method=index['method'])
+        os.replace(tmp_path, cache_path)
+    return table, index
+
+
+class ZipDirDataset(BaseDataset):
+    '''直接读取zip中的图片，不需要先解压。
+
+    第一次加载时解析zip的central directory，成员名称保存为SampleTable，位置、压缩后大小和压缩方式保存为numpy数组，
+    按zip路径、大小、mtime和img_dir缓存在index_cache_dir下，之后启动直接加载缓存。
+    读取时seek到成员的local header，读出数据后用zlib解压(deflate)或直接使用(stored)，再用cv2.imdecode解码；
+    每个进程(包括fork出的worker)在第一次读取时打开自己的文件句柄，不再使用时调用close()关闭。
+
+    示例:
+    ```python
+    dataset = ZipDirDataset('/data/faces.zip', dst_wh=256, img_dir='imgs')
+    name, img, label = dataset[0]
+    ```
+    Args:
+        zip_path: str, zip文件路径
+        dst_wh: int或[w, h], 缩放尺寸，为None时不缩放
+        img_dir: str, 只读取zip中该目录下的图片，为None时读取所有图片
+        label_name: str, zip中label文件的名称，内容交给parse_label解析
+        cfg: dict
+    '''
+    def __init__(self, zip_path, dst_wh=None, img_dir=None, label_name=None, cfg=None):
+        self.data_root = zip_path
+        self.dst_wh = dst_wh
+        self.img_dir = img_dir
+        self.label_name = label_name
+        self.cfg = cfg
+        self.fp = None
+        self.fp_pid = None
+        self.zf = None
+        self.load_data()
+        self.size = len(self.names)
+
+    def load_data(self):
+        prefix = '' if self.img_dir is None else self.img_dir.rstrip('/') + '/'
+        is_member = lambda name: name.startswith(prefix) and self.is_img_name(name)
+        # 子类可能重写is_img_name，类名也加入缓存的key
+        filter_key = '%s.%s|%s' % (type(self).__module__, type(self).__qualname__, prefix)
+        self.names, self.index = build_zip_index(self.data_root, is_member, get_index_cache_dir(self.cfg), filter_key)
+        #加载label
+        if self.label_name is not None:
+            with zipfile.ZipFile(self.data_root) as zf:
+                self.names.set_labels(self.parse_label(zf.read(self.label_name)))
+
+    def parse_label(self, data:bytes):
+        '''解析label文件，子类实现
+        :param data: bytes, label文件内容
+        :return: dict, key为zip中图片的完整名称，如imgs/img1.png
+        '''
+        return {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fp'], state['fp_pid'], state['zf'] = None, None, None
+        return state
+
+    def close(self):
+        '''关闭当前进程打开的文件句柄，之后读取时会重新打开
+        '''
+        if self.zf is not None:
+            self.zf.close()
+        if self.fp is not None:
+            self.fp.close()
+        self.fp, self.fp_pid, self.zf = None, None, None
+
+    def __del__(self):
+        # __init__中途失败时可能还没有这些属性
+        if getattr(self, 'fp', None) is not None:
+            self.close()
+
+    def get_fp(self):
+        '''当前进程的文件句柄，fork之后重新打开，避免多个进程共用文件位置
+        '''
+        if self.fp is None or self.fp_pid != os.getpid():
+            # fork得到的句柄也要关闭，否则每个worker都多占用一个文件描述符
+            self.close()
+            self.fp = open(self.data_root, 'rb')
+            self.fp_pid = os.getpid()
+        return self.fp
+
+    def read_member(self, index:int):
+        '''读取第index个成员解压后的数据
+        '''
+        fp = self.get_fp()
+        method = int(self.index['method'][index])
+        if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+            if self.zf is None:
+                self.zf = zipfile.ZipFile(fp)
+            return self.zf.read(self.names[index])
+        offset = int(self.index['offset'][index])
+        fp.seek(offset)
+        header = _LOCAL_HEADER.unpack(fp.read(_LOCAL_HEADER.size))
+        if header[0] != _LOCAL_MAGIC:
+            raise zipfile.BadZipFile('bad local header for %s' % self.names[index])
+        # local header中的文件名和extra长度可能与central directory不同，以local header为准
+        fp.seek(offset + _LOCAL_HEADER.size + header[9] + header[10])
+        data = fp.read(int(self.index['csize'][index]))
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        return data
+
+    def get_label(self, index):
+        return self.names.get_label(index)
+
+    def process_img(self, name, img, label):
+        return name, img, label
+
+    def __getitem__(self, index):
+        name = self.names[index]
+        img = self.resize(self.imdecode(self.read_member(index)), self.dst_wh)
+        return self.process_img(name, img, self.get_label(index))
+
+    def __len__(self):
+        return self.size
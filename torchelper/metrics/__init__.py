@@ -1,5 +1,26 @@
-from .fid import FID
-from .psnr import PSNR
-from .ssim import SSIM, SSIMNet
-from .lpips import LPIPS
-from .measure import Metric 
\ No newline at end of file
+import importlib
+
+# 按需导入，FID依赖scipy，LPIPS依赖lpips，只在使用时加载
+_LAZY_ATTRS = {
+    'FID': ('.fid', 'FID'),
+    'PSNR': ('.psnr', 'PSNR'),
+    'SSIM': ('.ssim', 'SSIM'),
+    'SSIMNet': ('.ssim', 'SSIMNet'),
+    'LPIPS': ('.lpips', 'LPIPS'),
+    'Metric': ('.measure', 'Metric'),
+}
+
+__all__ = list(_LAZY_ATTRS.keys())
+
+
+def __getattr__(attr):
+    if attr not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, attr))
+    module_name, attr_name = _LAZY_ATTRS[attr]
+    value = getattr(importlib.import_module(module_name, __name__), attr_name)
+    globals()[attr] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
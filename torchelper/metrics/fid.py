@@ -40,10 +40,10 @@ from tqdm import tqdm
 import cv2
 import numpy as np
 import torch
-from scipy import linalg
 from torch.nn.functional import adaptive_avg_pool2d
 
 from torchelper.metrics.measure import Metric
+from torchelper.utils.dist_util import get_device_by_id
 from torchelper.archs.inception import InceptionV3
 
 # try:
@@ -373,7 +373,8 @@ from torchelper.archs.inception import InceptionV3
 class FID(Metric):
     def __init__(self, tar_dir_or_npz, gpu_id=None, batch_size=20, rect=None, dst_size=None):
         super().__init__()
-        self.device = torch.device('cuda:'+str(gpu_id) if gpu_id is not None else 'cpu')
+        # gpu_id为None时在cpu上计算，否则使用cuda:<gpu_id>(cpu/gloo训练时为cpu)
+        self.device = get_device_by_id(gpu_id)
         self.rect = rect
         self.dst_size = dst_size
         self.batch_size = batch_size
@@ -466,6 +467,8 @@ class FID(Metric):
         Returns:
         --   : The Frechet Distance.
         """
+        # scipy较重，只在计算FID时导入
+        from scipy import linalg
 
         mu1 = np.atleast_1d(mu1)
         mu2 = np.atleast_1d(mu2)
@@ -2,12 +2,9 @@
 import os
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity as compare_ssim
-from skimage.metrics import peak_signal_noise_ratio as compare_psnr
 import torch
-from torchelper.utils.dist_util import get_rank
+from torchelper.utils.dist_util import get_rank, get_device_by_id
 from .measure import Metric
-import lpips
 
 
 class LPIPS(Metric):
@@ -16,7 +13,10 @@ class LPIPS(Metric):
         :param net: str, 网络结构
         '''
         super().__init__()
-        self.device = torch.device('cuda:'+str(gpu_id) if gpu_id is not None else 'cpu')
+        # lpips依赖较重，只在使用时导入
+        import lpips
+        # gpu_id为None时在cpu上计算，否则使用cuda:<gpu_id>(cpu/gloo训练时为cpu)
+        self.device = get_device_by_id(gpu_id)
         self.model = lpips.LPIPS(net=net)
         self.model = self.model.to(self.device)
     
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from torchelper.utils.dist_util import get_rank
+from torchelper.utils.dist_util import get_rank, get_device
 
 
 class BaseModel(nn.Module):
@@ -12,10 +12,7 @@ class BaseModel(nn.Module):
         self.init_lr = cfg['init_lr']
         self.callbacks = []
         self.gpu_id = get_rank()
-        if self.gpu_id>=0:
-            self.device = torch.device('cuda:'+str(self.gpu_id))
-        else:
-            self.device = torch.device('cpu')
+        self.device = get_device()
     def get_builder(self):
         return self.builder
         
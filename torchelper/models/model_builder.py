@@ -2,6 +2,7 @@
 import os
 import time
 import copy
+import contextlib
 # from abc import ABCMeta, abstractmethod
 import torch
 import torch.nn as nn
@@ -9,8 +10,9 @@ from torchelper.utils.dist_util import get_bare_model, master_only
 from torchelper.models import lr_scheduler as lr_scheduler
 from torch.nn.parallel import DataParallel, DistributedDataParallel
 from torch.cuda.amp import autocast, GradScaler
-from torchelper.utils.dist_util import get_rank
+from torchelper.utils.dist_util import get_rank, get_device
 from torchelper.models.base_model import BaseModel
+from torchelper.utils.step_timer import StepTimer
 
 class ModelBuilder():
     def __init__(self, is_train, ckpt_dir):
@@ -19,18 +21,86 @@ class ModelBuilder():
         self.ckpt_dir = ckpt_dir
         self.is_train = is_train
         self.gpu_id = get_rank()
-        if self.gpu_id>=0:
-            self.device = torch.device('cuda:'+str(self.gpu_id))
-        else:
-            self.device = torch.device('cpu')
+        self.device = get_device()
         self.models = {}
         self.amp_scaler = {}
-        # 默认只在GPU训练
-        torch.cuda.set_device(self.gpu_id)
+        # 阶段耗时统计，默认关闭，子类可用 with self.timer.phase('xxx'): 统计自定义阶段
+        self.timer = StepTimer()
+        # 梯度累积: 每accum_steps个micro-step执行一次optimizer.step
+        self.accum_steps = 1
+        self.accum_count = 0
+        # 所有模型的loss合并为一次反向传播
+        self.fused_backward = False
+        # 是否已检查过合并反向传播的计算图
+        self.fused_checked = False
+        # 断点续训位置(epoch, step)，由CkptCallback恢复训练状态时设置
+        self.resume_point = None
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.gpu_id)
+
+    def set_timer(self, timer:StepTimer):
+        self.timer = timer
+
+    def set_accum_steps(self, accum_steps:int):
+        '''设置梯度累积步数，等效batch为 batch_per_gpu * gpu数 * accum_steps
+        :param accum_steps: int, 累积的micro-step数，1表示不累积
+        '''
+        self.accum_steps = max(1, int(accum_steps))
+        self.accum_count = 0
+
+    def set_resume_point(self, epoch:int, step:int):
+        '''设置断点续训的位置
+        :param epoch: int, 保存时的epoch
+        :param step: int, 保存时已完成的最后一个step，-1表示该epoch已完成
+        '''
+        self.resume_point = (epoch, step)
+
+    def get_resume_point(self):
+        return self.resume_point
+
+    def get_scaler(self, model:BaseModel):
+        '''获取model对应的GradScaler，非混合精度模型返回None
+        '''
+        for key, net in self.models.items():
+            if self.get_bare_model(net) is model:
+                return self.amp_scaler.get(key, None)
+        return None
+
+    def set_fused_backward(self, fused_backward:bool):
+        '''开启后所有模型的loss求和后只做一次autograd反向传播，各模型仍使用各自的optimizer和GradScaler。
+        每个模型的参数会收到所有loss的梯度，只有各模型的loss互不经过其他模型的可训练参数时
+        (如判别器的输入对生成器输出detach)，结果才与逐个模型反向传播一致。
+        第一次合并反向传播前会检查计算图，某个模型的loss经过了其他模型的可训练参数时抛出ValueError，
+        例如生成器的对抗loss经过判别器，这种情况需要使用逐个模型反向传播。
+        :param fused_backward: bool
+        '''
+        self.fused_backward = fused_backward
+        self.fused_checked = False
+
+    def is_accum_begin(self):
+        '''当前micro-step是否是一次累积的开始（需要清空梯度）
+        '''
+        return self.accum_count % self.accum_steps == 0
+
+    def is_accum_end(self):
+        '''当前micro-step是否是一次累积的结束（需要更新参数）
+        '''
+        return (self.accum_count + 1) % self.accum_steps == 0
+
+    def accum_context(self):
+        '''包住一个micro-step的前向和反向，非累积结束的micro-step跳过DDP的梯度all-reduce
+        '''
+        stack = contextlib.ExitStack()
+        if not self.is_accum_end():
+            for __, model in self.models.items():
+                if isinstance(model, DistributedDataParallel):
+                    stack.enter_context(model.no_sync())
+        return stack
    
     def perform_cb(self, event:str, **args):
-        for __, model in self.models.items():
-            self.get_bare_model(model).perform_cb(event, **args)
+        with self.timer.phase('cb/' + event):
+            for __, model in self.models.items():
+                self.get_bare_model(model).perform_cb(event, **args)
 
     # def get_print_metric(self):
     #     metric_dicts = {}
@@ -77,9 +147,13 @@ class ModelBuilder():
         pass
     
     def backward_wrapper(self):
-        #半浮点和全浮点的在各自函数内自定判断
-        self.amp_backward()
-        self.backward()
+        if self.fused_backward:
+            self.fused_backward_step()
+        else:
+            #半浮点和全浮点的在各自函数内自定判断
+            self.amp_backward()
+            self.backward()
+        self.accum_count += 1
  
     def forward(self, epoch, step, data):
         pass
@@ -99,9 +173,14 @@ class ModelBuilder():
                 if optimizer is None:
                     continue
                 scaler = self.amp_scaler[key]
-                optimizer.zero_grad()
+                if self.is_accum_begin():
+                    optimizer.zero_grad()
+                if self.accum_steps > 1:
+                    loss = loss / self.accum_steps
                 # Scales loss. 为了梯度放大.
                 scaler.scale(loss).backward()
+                if not self.is_accum_end():
+                    continue
                 # scaler.step() 首先把梯度的值unscale回来.
                 # 如果梯度的值不是 infs 或者 NaNs, 那么调用optimizer.step()来更新权重,
                 # 否则，忽略step调用，从而保证权重不更新（不被破坏）
@@ -111,6 +190,76 @@ class ModelBuilder():
         
         # self.step_ema(0.5**(32 / (10 * 1000)))
 
+    def check_fused_graph(self, losses:dict):
+        '''检查每个模型的loss的计算图是否经过其他模型的可训练参数
+        :param losses: dict, {模型名称: loss}
+        '''
+        owners = {}
+        for key, model in self.models.items():
+            for p in self.get_bare_model(model).parameters():
+                if p.requires_grad:
+                    owners[id(p)] = key
+        for key, loss in losses.items():
+            seen = set()
+            stack = [loss.grad_fn]
+            while len(stack) > 0:
+                fn = stack.pop()
+                if fn is None or id(fn) in seen:
+                    continue
+                seen.add(id(fn))
+                # AccumulateGrad节点对应叶子tensor
+                var = getattr(fn, 'variable', None)
+                owner = owners.get(id(var), key) if var is not None else key
+                if owner != key:
+                    raise ValueError("fused_backward: loss of model '%s' reaches trainable parameters of model '%s', "
+                                     "detach its input or use sequential backward" % (key, owner))
+                stack.extend([next_fn for next_fn, __ in fn.next_functions])
+
+    def fused_backward_step(self):
+        '''所有模型的loss合并为一次反向传播，半浮点模型的loss先经过各自GradScaler放大
+        '''
+        items = []
+        losses = {}
+        for key, model in self.models.items():
+            bare_model = self.get_bare_model(model)
+            scaler = self.amp_scaler.get(key, None)
+            if scaler is not None:
+                with autocast():
+                    loss = self.get_loss(key, bare_model)
+            else:
+                loss = self.get_loss(key, bare_model)
+            if loss is None:
+                continue
+            optimizer = bare_model.get_optimizer()
+            if optimizer is None:
+                continue
+            if scaler is None:
+                loss = loss.float()
+            if self.accum_steps > 1:
+                loss = loss / self.accum_steps
+            if scaler is not None:
+                loss = scaler.scale(loss)
+            items.append((optimizer, scaler, loss))
+            losses[key] = loss
+        if len(items) == 0:
+            return
+        if not self.fused_checked:
+            self.check_fused_graph(losses)
+            self.fused_checked = True
+        if self.is_accum_begin():
+            for optimizer, __, __ in items:
+                optimizer.zero_grad()
+        # 一次遍历计算图
+        torch.autograd.backward([loss for __, __, loss in items])
+        if not self.is_accum_end():
+            return
+        for optimizer, scaler, __ in items:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+
     def get_loss(self, name, model):
         loss = model.get_loss()
         return loss
@@ -128,15 +277,20 @@ class ModelBuilder():
                 optimizer = self.get_bare_model(model).get_optimizer()
                 if optimizer is None:
                     continue
-                optimizer.zero_grad()
+                if self.is_accum_begin():
+                    optimizer.zero_grad()
+                if self.accum_steps > 1:
+                    loss = loss / self.accum_steps
                 loss.backward()
-                optimizer.step()
+                if self.is_accum_end():
+                    optimizer.step()
 
           
     def add_model(self, name:str, model:BaseModel):
         model.builder = self
         self.models[name] = self.model_to_device(model)
-        is_half = model.cfg.get('amp', False)
+        # 混合精度只在GPU上开启
+        is_half = model.cfg.get('amp', False) and self.device.type == 'cuda'
         if is_half:
             self.amp_scaler[name] = GradScaler()
         
@@ -145,9 +299,10 @@ class ModelBuilder():
         """Model to device. It also warps models with DistributedDataParallel.
         :param net: nn.Module
         """
-        net = net.cuda(self.gpu_id)
+        net = net.to(self.device)
         net = DistributedDataParallel(
-            net, device_ids=[self.gpu_id], find_unused_parameters=find_unused_parameters)
+            net, device_ids=[self.gpu_id] if self.device.type == 'cuda' else None,
+            find_unused_parameters=find_unused_parameters)
         return net
 
     def set_dataset(self, dataset):
@@ -9,7 +9,7 @@ from torchelper.utils.dist_util import get_bare_model, master_only
 from torchelper.models import lr_scheduler as lr_scheduler
 from torch.nn.parallel import DataParallel, DistributedDataParallel
 from torch.cuda.amp import autocast, GradScaler
-from torchelper.utils.dist_util import get_rank
+from torchelper.utils.dist_util import get_rank, get_device
 from torchelper.models.base_model import BaseModel
 
 class ModelGroup(BaseModel):
@@ -20,15 +20,12 @@ class ModelGroup(BaseModel):
         self.is_train = is_train
         # self.is_amp = is_amp
         self.gpu_id = get_rank()
-        if self.gpu_id>=0:
-            self.device = torch.device('cuda:'+str(self.gpu_id))
-        else:
-            self.device = torch.device('cpu')
+        self.device = get_device()
         # self.is_dist = is_dist
         self.models = {}
         self.amp_scaler = {}
-        # 默认只在GPU训练
-        torch.cuda.set_device(self.gpu_id)
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.gpu_id)
         self.last_interval_save_time = -1
         self.pth_list = []
     
@@ -147,7 +144,8 @@ class ModelGroup(BaseModel):
     def add_model(self, name:str, model:BaseModel):
         model.builder = self
         self.models[name] = self.model_to_device(model)
-        is_half = model.cfg.get('amp', False)
+        # 混合精度只在GPU上开启
+        is_half = model.cfg.get('amp', False) and self.device.type == 'cuda'
         if is_half:
             self.amp_scaler[name] = GradScaler()
         
@@ -156,11 +154,12 @@ class ModelGroup(BaseModel):
         """Model to device. It also warps models with DistributedDataParallel.
         :param net: nn.Module
         """
-        net = net.cuda(self.gpu_id)
+        net = net.to(self.device)
         # net = DataParallel(net, device_ids=self.gpu_ids)
         # if self.is_dist:
         net = DistributedDataParallel(
-            net, device_ids=[self.gpu_id], find_unused_parameters=find_unused_parameters)
+            net, device_ids=[self.gpu_id] if self.device.type == 'cuda' else None,
+            find_unused_parameters=find_unused_parameters)
         return net
 
     def set_dataset(self, dataset):
@@ -7,6 +7,7 @@ from ..archs.vgg_19 import VGG19_torch
 import torch.nn.functional as F
 from torch.nn.parallel import gather, parallel_apply, replicate
 from torch.cuda.amp import GradScaler
+from torchelper.utils.dist_util import get_device
 
 class OMGDDistiller(ModelGroup):
 
@@ -15,7 +16,7 @@ class OMGDDistiller(ModelGroup):
         self.connectors = []
         self.teacher_w = None
         self.student = None
-        self.vgg = VGG19_torch().cuda(gpu_id)
+        self.vgg = VGG19_torch().to(get_device())
     
  
     def add_student(self, teacher_w, name, cls_str, init_lr, loss_func, model_cfg, lr_scheduler):
@@ -28,7 +29,7 @@ class OMGDDistiller(ModelGroup):
         for t_chan, s_chan in zip(teacher_chans, student_chans):
             module = self.build_feature_connector(t_chan, s_chan)
             params.append(module.parameters())
-            self.connectors.append(module.cuda(self.gpu_id))
+            self.connectors.append(module.to(get_device()))
         optimizer = torch.optim.Adam(itertools.chain(*params), lr=init_lr, betas=(0.5, 0.999))
         self.optimizers[name] = optimizer
         self.loss_funcs[name] = loss_func
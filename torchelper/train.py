@@ -1,6 +1,6 @@
 import os
 import random
-from torchelper.utils.dist_util import get_rank
+from torchelper.utils.dist_util import get_rank, should_barrier, init_device, resolve_device_type
 from torchelper.models.model_builder import ModelBuilder
 from tqdm import tqdm
 import torch 
@@ -10,11 +10,14 @@ import torch.distributed as dist
 import torch.multiprocessing as mp
 from torchelper.utils.config import merge_cfg
 from torchelper.utils.cls_utils import get_cls, new_cls, auto_new_cls
-from torchelper.data.base_dataset import get_data_loader
+from torchelper.data.base_dataset import get_data_loader, set_loader_epoch
+from torchelper.validator import Validator
 import torch.backends.cudnn as cudnn
 import subprocess
-from torch.utils.tensorboard import SummaryWriter
 from torchelper.utils import logger
+from torchelper.utils.step_timer import StepTimer
+from torchelper.utils.tb_logger import AsyncTBLogger
+from torchelper.utils.scalar_accumulator import ScalarAccumulator
  
 
 def check_close_port(port):
@@ -73,84 +76,34 @@ def get_port(def_port):
     return get_port(def_port+1)
 
 
-def validate(net:ModelBuilder, epoch:int, val_dataset):
-    '''执行验证集
-    :param net: ModelBuilder子类实例
-    :param epoch: int, 当前epoch
-    :param val_dataset: 验证集
-    :return: 返回描述
-    :raises ValueError: 描述抛出异常场景
-    '''
-    if get_rank()==0:
-        net.set_eval()
-        # net.before_validate(epoch)
-        # time.sleep(10)
-        
-        val_data:dict = {}
-        
-        for data in tqdm(val_dataset):
-            res = net.validate(epoch, data)
-            if res is None:
-                continue
-            for key, val in res.items():
-                val_data[key] = val + val_data.get(key, 0)
-        
-        line = 'epoch: '+str(epoch)+', '
-        if val_data is not None:
-            val_arr = []
-            for key, val in val_data.items():
-                val_arr.append(key + ":" + str(val_data[key] * 1.0 / len(val_dataset)))
-            line = line+', '.join(val_arr)
-        # val_data = net.after_validate(epoch)
-        if val_data is not None:
-            val_arr = []
-            for key, val in val_data.items():
-                val_arr.append(key + ":" + str(val_data[key]))
-            line = line +','+ ', '.join(val_arr)
-        print(line)
-    torch.distributed.barrier()
-
-#更新tensorboard显示
-def update_tensorboard(builder:ModelBuilder, tb_writer, epoch, step, step_per_epoch_per_gpu, gpu_count):
-    if tb_writer is None:
+#更新tensorboard显示，各类别按tb_logger中设置的间隔提交到后台线程写入，标量由update_pbar写入
+def update_tensorboard(builder:ModelBuilder, tb_logger:AsyncTBLogger, epoch, step, step_per_epoch_per_gpu, gpu_count):
+    if tb_logger is None:
         return
-    audios = builder.get_audio_dict()
-    images = builder.get_img_dict()
-    scalars = builder.get_scalar_dict()
-    metrics = builder.get_metric_dict()
-    audios = audios if audios is not None else {}
-    images = images if images is not None else {}
-    scalars = scalars if scalars is not None else {}
-    metrics = metrics if metrics is not None else {}
- 
-    step =  (epoch*step_per_epoch_per_gpu+step)*gpu_count
-    # print(epoch, step_per_epoch_per_gpu, epoch*step_per_epoch_per_gpu)
-    for k, v in audios.items():
-        if v is None:
-            logger.warn(k+" is None ... ")
-            continue    
-        tb_writer.add_audio(k, v, step, sample_rate=16000)
-    for k, v in images.items():
-        if v is None:
-            logger.warn(k+" is None ... ")
-            continue
-        tb_writer.add_image(k, v, step)
-    for k, v in scalars.items():
-        if v is None:
-            logger.warn(k+" is None ... ")
-            continue
-        tb_writer.add_scalar(k, v, step)
-    for k, v in metrics.items():
-        if v is None:
-            logger.warn(k+" is None ... ")
-            continue
-        tb_writer.add_scalar(k, v, step)
+    it = epoch*step_per_epoch_per_gpu+step
+    global_step = it*gpu_count
+    if tb_logger.is_due('audio', it):
+        tb_logger.add('audio', builder.get_audio_dict(), global_step)
+    if tb_logger.is_due('image', it):
+        tb_logger.add('image', builder.get_img_dict(), global_step)
+    if tb_logger.is_due('metric', it):
+        tb_logger.add('metric', builder.get_metric_dict(), global_step)
 
-def update_pbar(builder:ModelBuilder, pbar):
-    if pbar is None:
+def update_pbar(builder:ModelBuilder, pbar, scalar_acc:ScalarAccumulator, tb_logger:AsyncTBLogger,
+                epoch, step, step_per_epoch_per_gpu, gpu_count, interval):
+    '''每个step在设备上累加get_scalar_dict返回的标量，每隔interval个step
+    一次性拷贝到主机，将均值显示到进度条并写入tensorboard
+    '''
+    scalar_acc.add(builder.get_scalar_dict())
+    it = epoch*step_per_epoch_per_gpu+step
+    if (it+1) % interval != 0:
+        return
+    scalars = scalar_acc.flush()
+    if len(scalars) == 0:
         return
-    scalars = builder.get_scalar_dict()
-    if scalars is None:
+    if tb_logger is not None:
+        tb_logger.add('scalar', scalars, it*gpu_count)
+    if pbar is None:
         return
     msg = []
     for k, v in scalars.items():
@@ -164,50 +117,101 @@ def train(gpu_id, cfg, is_dist):
     train_dataset = auto_new_cls(train_data_cfg)
     val_dataset = auto_new_cls(val_data_cfg)
     gpu_count = len(cfg['ori_gpu_ids'])
- 
-    train_dataloader = get_data_loader(cfg['batch_per_gpu'], train_dataset, num_workers=0, dist=True)
-    val_dataloader = get_data_loader(cfg['batch_per_gpu'], val_dataset, dist=False)
 
     builder:ModelBuilder = get_cls(cfg['model_builder'])(cfg, True, cfg['ckpt_dir'])
+    # prefetch>0时后台线程预取batch并提前拷贝到builder.device
+    pin_memory = builder.device.type == 'cuda'
+    train_dataloader = get_data_loader(cfg['batch_per_gpu'], train_dataset, num_workers=cfg.get('num_workers', 0), dist=True,
+                                       pin_memory=pin_memory, prefetch=cfg.get('prefetch', 0), device=builder.device)
+    # 验证集分片到各个rank上执行
+    validator = Validator(val_dataset, cfg['batch_per_gpu'], num_workers=cfg.get('num_workers', 0), pin_memory=pin_memory)
  
     builder.set_dataset(train_dataset)
-    dataset_size = len(train_dataloader)
+    try:
+        dataset_size = len(train_dataloader)
+    except TypeError:
+        # 没有长度的IterableDataset无法确定每个epoch的step数
+        raise ValueError('train dataset %s has no length, e.g. set samples_per_rank for TarShardDataset' % type(train_dataset).__name__)
+    # profile_interval>0时统计各阶段耗时，每隔profile_interval个step输出分位数
+    timer = StepTimer(enabled=cfg.get('profile_interval', 0) > 0, interval=cfg.get('profile_interval', 0),
+                      sync_cuda=cfg.get('profile_sync_cuda', False))
+    builder.set_timer(timer)
+    builder.set_accum_steps(cfg.get('accum_steps', 1))
+    builder.set_fused_backward(cfg.get('fused_backward', False))
+    # 多卡同步策略: 'none', 'epoch' 或 每N个step同步一次
+    sync_policy = cfg.get('dist_sync', 'none')
     
     tb_writer = None
     step_per_epoch_per_gpu = dataset_size 
     if gpu_id==0:
-        tb_writer = SummaryWriter(cfg['ckpt_dir'])
+        # tb_intervals: 各类别写入间隔，例如 {'metric': 10, 'image': 500}，标量的间隔由scalar_interval决定
+        tb_writer = AsyncTBLogger(cfg['ckpt_dir'], cfg.get('tb_intervals', None), cfg.get('tb_queue_size', 16))
+
+    # 标量在设备上累加，每隔scalar_interval个step刷新一次进度条和tensorboard
+    scalar_acc = ScalarAccumulator()
+    scalar_interval = max(1, cfg.get('scalar_interval', 10))
 
     builder.perform_cb('on_begin_train')
-    for epoch in range(cfg['start_epoch'], cfg['total_epoch']):
-        # validate(builder, epoch, val_dataloader)
+    # 断点续训: 从保存的epoch和step继续，sampler直接跳过已训练的样本
+    start_epoch, start_step = cfg['start_epoch'], 0
+    resume_point = builder.get_resume_point()
+    if resume_point is not None:
+        start_epoch, start_step = resume_point[0], resume_point[1] + 1
+        if resume_point[1] < 0:
+            start_epoch, start_step = resume_point[0] + 1, 0
+    for epoch in range(start_epoch, cfg['total_epoch']):
         builder.set_train()
+        epoch_start_step = start_step if epoch == start_epoch else 0
+        set_loader_epoch(train_dataloader, epoch, epoch_start_step)
         if gpu_id==0:
             pbar = tqdm(train_dataloader)
-            enum_data = enumerate(pbar)
+            enum_data = enumerate(timer.iter(pbar, 'data'), epoch_start_step)
         else:
             pbar = None
-            enum_data =  enumerate(train_dataloader)
+            enum_data =  enumerate(timer.iter(train_dataloader, 'data'), epoch_start_step)
         builder.perform_cb('on_begin_epoch', epoch=epoch)
         for i, data in enum_data:
             builder.on_begin_forward(data, epoch, i)
             builder.perform_cb('on_begin_step', epoch=epoch, step=i)
-            builder.forward_wrapper(epoch, i, data)
-            builder.on_end_forward(  epoch, i)
-            builder.on_begin_backward( epoch, i)
-            # 计算loss
-            builder.backward_wrapper()
-            if is_dist:   # 多卡同步
-                torch.distributed.barrier()
+            # 梯度累积时，非累积结束的micro-step跳过DDP梯度同步
+            with builder.accum_context():
+                with timer.phase('forward'):
+                    builder.forward_wrapper(epoch, i, data)
+                builder.on_end_forward(  epoch, i)
+                builder.on_begin_backward( epoch, i)
+                # 计算loss
+                with timer.phase('backward'):
+                    builder.backward_wrapper()
+            if is_dist and should_barrier(sync_policy, i):   # 多卡同步
+                with timer.phase('barrier'):
+                    torch.distributed.barrier()
             builder.on_end_backward( epoch, i)
             builder.perform_cb('on_end_step', epoch=epoch, step=i)
             if gpu_id==0:
-                update_pbar(builder, pbar)
-                update_tensorboard(builder, tb_writer, epoch, i, step_per_epoch_per_gpu, gpu_count)
+                with timer.phase('pbar'):
+                    update_pbar(builder, pbar, scalar_acc, tb_writer, epoch, i, step_per_epoch_per_gpu, gpu_count, scalar_interval)
+                with timer.phase('tensorboard'):
+                    update_tensorboard(builder, tb_writer, epoch, i, step_per_epoch_per_gpu, gpu_count)
+            if timer.step():
+                timer.report(tb_writer, (epoch*step_per_epoch_per_gpu+i)*gpu_count)
+        if is_dist and should_barrier(sync_policy, -1, epoch_end=True):
+            with timer.phase('barrier'):
+                torch.distributed.barrier()
         builder.perform_cb('on_end_epoch', epoch=epoch)
         # builder.save_model(epoch, save_max_count, save_max_time)
-        validate(builder, epoch, val_dataloader)
+        val_data = validator.run(builder, epoch)
+        if tb_writer is not None:
+            tb_writer.add('metric', {'val/'+k: v for k, v in val_data.items()}, (epoch+1)*step_per_epoch_per_gpu*gpu_count)
+            # 图片缓存的命中统计(rank0上所有worker)
+            get_cache_stats = getattr(train_dataset, 'get_img_cache_stats', None)
+            cache_stats = get_cache_stats() if get_cache_stats is not None else None
+            if cache_stats is not None:
+                tb_writer.add('metric', {'data/img_cache_hit_rate': cache_stats['hit_rate'],
+                                         'data/img_cache_hits': cache_stats['hits'],
+                                         'data/img_cache_misses': cache_stats['misses']}, (epoch+1)*step_per_epoch_per_gpu*gpu_count)
     builder.perform_cb('on_end_train')
+    if tb_writer is not None:
+        tb_writer.close()
 
 
 def train_worker(gpu_id, nprocs, cfg, is_dist, port):
@@ -220,18 +224,30 @@ def train_worker(gpu_id, nprocs, cfg, is_dist, port):
     cudnn.deterministic = True
     # 提升速度，主要对input shape是固定时有效，如果是动态的，耗时反而慢
     torch.backends.cudnn.benchmark = True
-    dist.init_process_group(backend='nccl',
+    # cfg['device']为'cpu'时使用gloo后端
+    device_type = resolve_device_type(cfg.get('device', None))
+    dist.init_process_group(backend='nccl' if device_type == 'cuda' else 'gloo',
                             init_method='tcp://127.0.0.1:'+str(port),
                             world_size=len(cfg['gpu_ids']),
                             rank=gpu_id)
 
-    torch.cuda.set_device(gpu_id)
+    init_device(device_type)
+    if device_type == 'cpu':
+        # 按进程数划分intra-op线程，避免多个进程抢占同一批核
+        threads = cfg.get('threads_per_proc', 0)
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // nprocs)
+        torch.set_num_threads(threads)
     # 按batch分割给各个GPU
     # cfg['batch_size'] = int(cfg['batch_size'] / nprocs)
     train(gpu_id, cfg, is_dist)
 
 def train_main(cfg):
-    check_close_gpu_ids(cfg['ori_gpu_ids'])
+    '''启动多进程训练，cfg['device']为'cpu'时使用gloo后端在CPU上数据并行，
+    进程数仍由gpu_ids的数量决定
+    '''
+    if resolve_device_type(cfg.get('device', None)) == 'cuda':
+        check_close_gpu_ids(cfg['ori_gpu_ids'])
     # check_close_port(cfg['port'])
     gpu_nums = len(cfg['gpu_ids'])
     # if gpu_nums>1:
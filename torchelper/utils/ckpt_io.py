@@ -0,0 +1,263 @@
+'''checkpoint读写工具
+'''
+import os
+import zlib
+import lzma
+import hashlib
+import numpy as np
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+def save_file(obj, path:str, fsync:bool=True):
+    '''torch.save到临时文件，fsync后再替换目标文件，保证不会留下写了一半的checkpoint
+    :param obj: 待保存对象
+    :param path: str, 保存路径
+    :param fsync: bool, 是否在替换前把数据刷到磁盘
+    '''
+    dir_path = os.path.dirname(path)
+    if len(dir_path) > 0 and not os.path.isdir(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_file(path:str, mmap:bool=True):
+    '''加载checkpoint到cpu，mmap=True时文件被内存映射，只有真正用到的tensor才会从磁盘读取
+    （需要torch>=2.1，低版本自动退化为普通加载）
+    :param path: str, 文件路径
+    :param mmap: bool, 是否内存映射
+    '''
+    try:
+        return torch.load(path, map_location='cpu', mmap=mmap, weights_only=False)
+    except TypeError: # 低版本torch不支持mmap/weights_only参数
+        return torch.load(path, map_location=lambda storage, loc: storage)
+    except RuntimeError: # 旧的非zip格式文件不支持mmap
+        if not mmap:
+            raise
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def build_index(state_dict:dict):
+    '''生成state_dict中tensor的索引，不需要读取tensor数据即可查看checkpoint内容
+    :return: dict, {key: {'shape': list, 'dtype': str, 'nbytes': int}}
+    '''
+    index = {}
+    for k, v in state_dict.items():
+        if isinstance(v, torch.Tensor):
+            index[k] = {'shape': list(v.shape), 'dtype': str(v.dtype).replace('torch.', ''),
+                        'nbytes': v.numel() * v.element_size()}
+    return index
+
+
+def tensor_hash(t:torch.Tensor):
+    '''按tensor的dtype、shape和数据计算sha1
+    '''
+    t = t.detach().cpu().contiguous()
+    sha1 = hashlib.sha1()
+    sha1.update(('%s%s' % (t.dtype, tuple(t.shape))).encode('utf-8'))
+    sha1.update(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class BlobStore():
+    '''按内容哈希保存tensor的目录，相同内容的tensor只保存一次，
+    多个checkpoint通过哈希引用同一个文件
+    '''
+    def __init__(self, root:str):
+        self.root = root
+
+    def path(self, h:str):
+        return os.path.join(self.root, h + '.pth')
+
+    def has(self, h:str):
+        return os.path.isfile(self.path(h))
+
+    def get(self, h:str):
+        return load_file(self.path(h))
+
+    def gc(self, keep:set):
+        '''删除不在keep中的blob
+        :return: list, 被删除的哈希
+        '''
+        if not os.path.isdir(self.root):
+            return []
+        removed = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.pth') or name[:-4] in keep:
+                continue
+            os.remove(os.path.join(self.root, name))
+            removed.append(name[:-4])
+        return removed
+
+
+EXPORT_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+EXPORT_CODECS = [None, 'zlib', 'lzma']
+
+
+def _compress(data:bytes, codec:str, level:int):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(data:bytes, codec:str):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    return data
+
+
+def pack_weights(state_dict:dict, dtype:str='fp16', codec:str='zlib', level:int=6):
+    '''把state_dict打包成导出格式：浮点tensor转为fp16/bf16，按字节拆分(shuffle)后用无损压缩算法压缩，
+    其余tensor保持原来的dtype，只做压缩
+    :param state_dict: dict
+    :param dtype: str, 'fp16'或'bf16'
+    :param codec: str, None/'zlib'/'lzma'
+    :param level: int, 压缩等级
+    :return: dict, 可以直接save_file保存
+    '''
+    if dtype not in EXPORT_DTYPES:
+        raise ValueError('Unknown export dtype: ' + str(dtype))
+    if codec not in EXPORT_CODECS:
+        raise ValueError('Unknown export codec: ' + str(codec))
+    tensors = {}
+    for k, v in state_dict.items():
+        if not isinstance(v, torch.Tensor):
+            continue
+        v = v.detach().cpu()
+        src_dtype = v.dtype
+        if v.is_floating_point():
+            v = v.to(EXPORT_DTYPES[dtype])
+        v = v.contiguous()
+        # 同一位置的字节放在一起（如fp16的高字节几乎只有少数取值），压缩率更高
+        data = v.reshape(-1).view(torch.uint8).numpy().reshape(-1, v.element_size()).T.tobytes()
+        tensors[k] = {
+            'shape': list(v.shape),
+            'dtype': str(src_dtype).replace('torch.', ''),
+            'store_dtype': str(v.dtype).replace('torch.', ''),
+            'data': _compress(data, codec, level),
+        }
+    return {'format': 'export', 'dtype': dtype, 'codec': codec, 'tensors': tensors}
+
+
+def unpack_weights(obj:dict, dtypes:dict=None):
+    '''把pack_weights的结果还原为state_dict，浮点tensor转换回原来的dtype
+    :param obj: dict, pack_weights的结果
+    :param dtypes: dict, {key: torch.dtype}，指定时转换为对应的dtype（如模型参数的dtype）
+    :return: dict
+    '''
+    state_dict = {}
+    for k, v in obj['tensors'].items():
+        store_dtype = getattr(torch, v['store_dtype'])
+        element_size = torch.empty((), dtype=store_dtype).element_size()
+        data = np.frombuffer(_decompress(v['data'], obj['codec']), dtype=np.uint8)
+        data = np.ascontiguousarray(data.reshape(element_size, -1).T)
+        t = torch.from_numpy(data).view(store_dtype).reshape(v['shape'])
+        dtype = getattr(torch, v['dtype'])
+        if dtypes is not None and k in dtypes:
+            dtype = dtypes[k]
+        state_dict[k] = t.to(dtype)
+    return state_dict
+
+
+def is_packed(obj):
+    return isinstance(obj, dict) and obj.get('format', None) == 'export'
+
+
+def rebuild_container(obj, values:list):
+    '''用新的元素构造和obj同类型的容器。namedtuple按位置参数构造，defaultdict保留default_factory，
+    其他dict/list/tuple的子类需要能用一个可迭代对象构造
+    :param obj: dict/list/tuple
+    :param values: list, dict时为[(k, v)]，否则为元素
+    '''
+    if isinstance(obj, defaultdict):
+        return type(obj)(obj.default_factory, values)
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*values)
+    return type(obj)(values)
+
+
+def map_tensors(obj, func):
+    '''递归地对dict/list/tuple(包括namedtuple、defaultdict)中的tensor执行func，返回新的容器
+    '''
+    if isinstance(obj, torch.Tensor):
+        return func(obj)
+    if isinstance(obj, dict):
+        return rebuild_container(obj, [(k, map_tensors(v, func)) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return rebuild_container(obj, [map_tensors(v, func) for v in obj])
+    return obj
+
+
+def snapshot_state(obj, staging:bool=True):
+    '''复制state_dict，使训练可以继续修改参数而不影响待保存的数据
+    :param obj: state_dict等包含tensor的对象
+    :param staging: bool, True时gpu上的tensor先在显存中clone（很快），拷贝到内存的工作留给后台线程；
+        False时在当前线程直接拷贝到内存
+    '''
+    def copy_tensor(t):
+        t = t.detach()
+        if staging and t.is_cuda:
+            return t.clone()
+        return t.to('cpu', copy=True)
+    return map_tensors(obj, copy_tensor)
+
+
+class AsyncSaver():
+    '''后台线程保存checkpoint，最多同时有max_inflight个未完成的保存，
+    超过时submit会等待最早的保存完成。
+
+    示例:
+    ```python
+    saver = AsyncSaver(max_inflight=1)
+    saver.submit([(snapshot_state(model.state_dict()), path)])
+    ...
+    saver.wait()  # 训练结束前等待所有保存完成
+    ```
+    Args:
+        max_inflight: int, 最多未完成的保存数量
+        fsync: bool, 写完后是否fsync
+    '''
+    def __init__(self, max_inflight:int=1, fsync:bool=True):
+        self.max_inflight = max(1, max_inflight)
+        self.fsync = fsync
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = deque()
+
+    def _write(self, jobs, on_done):
+        for job in jobs:
+            obj, path = job[0], job[1]
+            obj = map_tensors(obj, lambda t: t.cpu())
+            # 可选的第三项为编码函数(如pack_weights)，在后台线程执行
+            if len(job) > 2 and job[2] is not None:
+                obj = job[2](obj)
+            save_file(obj, path, self.fsync)
+            print('save:', path)
+        if on_done is not None:
+            on_done()
+
+    def submit(self, jobs, on_done=None):
+        '''提交一次保存
+        :param jobs: list, [(obj, path)]或[(obj, path, encode)]，obj需要是snapshot_state复制后的数据，
+            encode为保存前对obj执行的函数
+        :param on_done: 所有文件写完后在后台线程中调用的函数
+        '''
+        while len(self.futures) >= self.max_inflight:
+            self.futures.popleft().result()
+        self.futures.append(self.executor.submit(self._write, jobs, on_done))
+
+    def wait(self):
+        '''等待所有未完成的保存
+        '''
+        while len(self.futures) > 0:
+            self.futures.popleft().result()
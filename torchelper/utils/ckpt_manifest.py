@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import threading
+
+
+class CkptManifest():
+    '''ckpt_dir下记录checkpoint的清单文件(manifest_<name>.json)，每次修改都原子地写回磁盘，
+    重启后可以直接找到最新/最优的checkpoint，不需要扫描目录。
+
+    文件内容:
+    ```
+    {
+        "latest": 12,            # 最近写入的checkpoint(epoch>=0的优先)
+        "seq": 3,                # 写入序号，清理和latest按写入顺序而不是epoch大小
+        "best": 10,              # monitor指标最优的epoch
+        "entries": {
+            "12": {"epoch": 12, "seq": 3, "files": [...], "size": 1024, "time": 1700000000.0,
+                   "metrics": {"loss": 0.1}, "keep": false, "blobs": [...]},
+            ...
+        },
+        "state_blobs": [...]     # 断点续训状态文件引用的blob
+    }
+    ```
+    Args:
+        ckpt_dir: str, checkpoint目录
+        name: str, 模型名称
+        monitor: str, 选择最优checkpoint的指标名称，为None时没有best
+        mode: str, 'min'或'max'，monitor越小/越大越好
+    '''
+    def __init__(self, ckpt_dir:str, name:str, monitor:str=None, mode:str='min'):
+        if mode not in ['min', 'max']:
+            raise ValueError('Unknown mode: ' + str(mode))
+        self.path = os.path.join(ckpt_dir, 'manifest_%s.json' % name)
+        self.monitor = monitor
+        self.mode = mode
+        # 异步保存时会在后台线程更新
+        self.lock = threading.Lock()
+        self.data = {'latest': None, 'best': None, 'entries': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _metric(self, entry):
+        if self.monitor is None:
+            return None
+        return entry.get('metrics', {}).get(self.monitor, None)
+
+    def _is_better(self, a, b):
+        if b is None:
+            return True
+        return a < b if self.mode == 'min' else a > b
+
+    def _order(self, entry):
+        # 旧版本的manifest没有seq，排在前面并按时间排序
+        return (entry.get('seq', -1), entry.get('time', 0))
+
+    def _update_latest(self):
+        '''最近写入的checkpoint，训练前保存的epoch=-1只在没有其他checkpoint时作为latest
+        '''
+        entries = list(self.data['entries'].values())
+        trained = [e for e in entries if e['epoch'] >= 0]
+        if len(trained) > 0:
+            entries = trained
+        latest = max(entries, key=self._order, default=None)
+        self.data['latest'] = latest['epoch'] if latest is not None else None
+
+    def _update_best(self):
+        best, best_val = None, None
+        for key, entry in self.data['entries'].items():
+            val = self._metric(entry)
+            if val is not None and self._is_better(val, best_val):
+                best, best_val = entry['epoch'], val
+        self.data['best'] = best
+
+    def add(self, epoch:int, files:list, metrics:dict=None, keep:bool=False, blobs:list=None):
+        '''记录一个已经写完的checkpoint
+        :param epoch: int
+        :param files: list, checkpoint包含的文件路径
+        :param metrics: dict, 保存时的指标
+        :param keep: bool, 是否永久保留，不参与清理
+        :param blobs: list, checkpoint引用的blob哈希
+        '''
+        with self.lock:
+            self.data['seq'] = self.data.get('seq', 0) + 1
+            entry = {
+                'epoch': epoch,
+                'seq': self.data['seq'],
+                'files': [os.path.basename(f) for f in files],
+                'size': sum([os.path.getsize(f) for f in files if os.path.isfile(f)]),
+                'time': time.time(),
+                'metrics': metrics if metrics is not None else {},
+                'keep': keep,
+                'blobs': blobs if blobs is not None else [],
+            }
+            self.data['entries'][str(epoch)] = entry
+            self._update_latest()
+            val = self._metric(entry)
+            best = self.get(self.data['best'])
+            if val is not None and (best is None or self._is_better(val, self._metric(best))):
+                self.data['best'] = epoch
+            self.save()
+
+    def set_state_blobs(self, blobs:list):
+        '''记录断点续训状态文件引用的blob
+        '''
+        with self.lock:
+            self.data['state_blobs'] = blobs
+            self.save()
+
+    def referenced_blobs(self):
+        '''所有checkpoint和状态文件引用的blob
+        '''
+        with self.lock:
+            refs = set(self.data.get('state_blobs', []))
+            for entry in self.data['entries'].values():
+                refs.update(entry.get('blobs', []))
+            return refs
+
+    def get(self, epoch):
+        if epoch is None:
+            return None
+        return self.data['entries'].get(str(epoch), None)
+
+    def latest(self):
+        '''最近写入的checkpoint的epoch，没有时返回None
+        '''
+        return self.data['latest']
+
+    def best(self):
+        '''monitor指标最优的epoch，没有时返回None
+        '''
+        return self.data['best']
+
+    def prune(self, keep_last:int, keep_best:int=0):
+        '''删除多余的checkpoint文件，保留最近写入的keep_last个、monitor最优的keep_best个，以及标记为keep的
+        :param keep_last: int, <=0时不清理
+        :param keep_best: int
+        :return: list, 被删除的epoch
+        '''
+        if keep_last <= 0:
+            return []
+        with self.lock:
+            entries = [e for e in self.data['entries'].values() if not e.get('keep', False)]
+            entries = sorted(entries, key=self._order)
+            retain = set([e['epoch'] for e in entries[-keep_last:]])
+            if keep_best > 0 and self.monitor is not None:
+                scored = [e for e in entries if self._metric(e) is not None]
+                scored = sorted(scored, key=self._metric, reverse=self.mode == 'max')
+                retain.update([e['epoch'] for e in scored[:keep_best]])
+            removed = []
+            ckpt_dir = os.path.dirname(self.path)
+            for entry in entries:
+                if entry['epoch'] in retain:
+                    continue
+                for name in entry['files']:
+                    path = os.path.join(ckpt_dir, name)
+                    if os.path.exists(path):
+                        os.remove(path)
+                del self.data['entries'][str(entry['epoch'])]
+                removed.append(entry['epoch'])
+            if len(removed) > 0:
+                self._update_latest()
+                self._update_best()
+                self.save()
+            return removed
@@ -1,6 +1,11 @@
 import functools
+import torch
 import torch.distributed as dist
 from torch.nn.parallel import DataParallel, DistributedDataParallel
+from torchelper.utils.ckpt_io import map_tensors, rebuild_container
+
+# 当前进程使用的设备类型: 'cuda' 或 'cpu'，由init_device设置
+_device_type = None
 
 def get_rank():
     rank = 0
@@ -9,6 +14,49 @@ def get_rank():
             rank = dist.get_rank()
     return rank
 
+def resolve_device_type(device_type=None):
+    '''解析设备类型，未指定时有GPU则用cuda，否则用cpu
+    :param device_type: str, 'cuda'/'cpu'/None
+    :return: str
+    '''
+    if device_type is None:
+        device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device_type not in ['cuda', 'cpu']:
+        raise ValueError('Unknown device type: ' + str(device_type))
+    return device_type
+
+def init_device(device_type=None):
+    '''设置当前进程的设备类型，每个训练进程启动时调用一次
+    :param device_type: str, 'cuda'/'cpu'/None
+    '''
+    global _device_type
+    _device_type = resolve_device_type(device_type)
+    if _device_type == 'cuda':
+        torch.cuda.set_device(get_rank())
+    return _device_type
+
+def get_device_type():
+    if _device_type is None:
+        return resolve_device_type()
+    return _device_type
+
+def get_device():
+    '''当前进程使用的设备，cuda时每个rank对应一块卡
+    :return: torch.device
+    '''
+    if get_device_type() == 'cuda':
+        return torch.device('cuda:' + str(get_rank()))
+    return torch.device('cpu')
+
+def get_device_by_id(gpu_id=None):
+    '''指定编号的设备，gpu_id为None或当前进程使用cpu(如gloo训练)时返回cpu
+    :param gpu_id: int, gpu编号
+    :return: torch.device
+    '''
+    if gpu_id is not None and get_device_type() == 'cuda':
+        return torch.device('cuda:%d' % gpu_id)
+    return torch.device('cpu')
+
 def master_only(func):
 
     @functools.wraps(func)
@@ -25,4 +73,146 @@ def get_bare_model(net):
     """
     if isinstance(net, (DataParallel, DistributedDataParallel)):
         net = net.module
-    return net
\ No newline at end of file
+    return net
+def should_barrier(sync_policy, step:int, epoch_end:bool=False):
+    '''根据同步策略判断当前是否需要执行dist.barrier。
+    DDP反向传播时的梯度all-reduce已经会同步各个进程，一般不需要每个step都barrier。
+    :param sync_policy: str/int, 'none': 从不同步; 'epoch': 每个epoch结束时同步; int N: 每N个step同步一次
+    :param step: int, 当前epoch中的step数
+    :param epoch_end: bool, 是否是epoch结束时的调用
+    :return: bool
+    '''
+    if sync_policy is None or sync_policy == 'none':
+        return False
+    if sync_policy == 'epoch':
+        return epoch_end
+    n = int(sync_policy)
+    if n <= 0 or epoch_end:
+        return False
+    return (step + 1) % n == 0
+
+class _TensorMeta():
+    '''broadcast_state中代替tensor发送的占位符
+    '''
+    __slots__ = ['index', 'shape', 'dtype']
+
+    def __init__(self, index, shape, dtype):
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return (self.index, self.shape, self.dtype)
+
+    def __setstate__(self, state):
+        self.index, self.shape, self.dtype = state
+
+def _collect_metas(obj, metas):
+    if isinstance(obj, _TensorMeta):
+        metas.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _collect_metas(v, metas)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _collect_metas(v, metas)
+
+def broadcast_state(obj, src:int=0, bucket_mb:int=64):
+    '''把rank src上的obj(可以是包含tensor的dict/list/tuple，包括namedtuple和defaultdict，例如checkpoint)广播到所有rank，
+    只有src需要读文件。先用broadcast_object_list发送不含tensor数据的结构，
+    再把tensor按dtype拼接成不超过bucket_mb的桶，用dist.broadcast发送。
+    :param obj: src上的对象，其他rank传None即可
+    :param src: int, 发送的rank
+    :param bucket_mb: int, 每个桶的大小(MB)
+    :return: obj，非src的rank上tensor在cpu上
+    '''
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return obj
+    rank = get_rank()
+    tensors = []
+    skeleton = None
+    if rank == src:
+        def to_meta(t):
+            tensors.append(t)
+            return _TensorMeta(len(tensors) - 1, tuple(t.shape), t.dtype)
+        skeleton = map_tensors(obj, to_meta)
+    objs = [skeleton]
+    dist.broadcast_object_list(objs, src=src)
+    skeleton = objs[0]
+    metas = []
+    _collect_metas(skeleton, metas)
+    if len(metas) == 0:
+        return obj if rank == src else skeleton
+
+    # 按dtype分桶广播，nccl只能广播gpu上的tensor
+    device = get_device() if dist.get_backend() == 'nccl' else torch.device('cpu')
+    bucket_bytes = bucket_mb * 1024 * 1024
+    results = [None] * len(metas)
+    by_dtype = {}
+    for meta in sorted(metas, key=lambda m: m.index):
+        by_dtype.setdefault(meta.dtype, []).append(meta)
+    for dtype, dtype_metas in by_dtype.items():
+        element_size = torch.empty((), dtype=dtype).element_size()
+        bucket, bucket_size = [], 0
+        for i, meta in enumerate(dtype_metas):
+            numel = 1
+            for s in meta.shape:
+                numel *= s
+            bucket.append((meta, numel))
+            bucket_size += numel * element_size
+            if bucket_size < bucket_bytes and i < len(dtype_metas) - 1:
+                continue
+            total = sum([n for __, n in bucket])
+            if rank == src:
+                buf = torch.cat([tensors[m.index].detach().reshape(-1).to('cpu') for m, __ in bucket]).to(device)
+            else:
+                buf = torch.empty(total, dtype=dtype, device=device)
+            dist.broadcast(buf, src=src)
+            if rank != src:
+                buf = buf.cpu()
+                offset = 0
+                for m, n in bucket:
+                    results[m.index] = buf[offset:offset + n].view(m.shape).clone()
+                    offset += n
+            bucket, bucket_size = [], 0
+    if rank == src:
+        return obj
+
+    def restore(o):
+        if isinstance(o, _TensorMeta):
+            return results[o.index]
+        if isinstance(o, dict):
+            return rebuild_container(o, [(k, restore(v)) for k, v in o.items()])
+        if isinstance(o, (list, tuple)):
+            return rebuild_container(o, [restore(v) for v in o])
+        return o
+    return restore(skeleton)
+
+class _SrcError():
+    '''broadcast_call中src上的函数抛出异常时代替结果发送的标记
+    '''
+    def __init__(self, message:str):
+        self.message = message
+
+def broadcast_call(func, src:int=0, bucket_mb:int=64):
+    '''只在rank src上调用func()，返回值用broadcast_state广播到所有rank。
+    func抛出异常时把异常信息广播出去，所有rank都抛出异常，其他rank不会一直等待广播直到超时
+    :param func: 无参数的函数，返回值要能被broadcast_state广播
+    :param src: int, 调用func的rank
+    :param bucket_mb: int, 每个桶的大小(MB)
+    :return: func()的返回值
+    '''
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return func()
+    obj = None
+    if get_rank() == src:
+        try:
+            obj = func()
+        except Exception as e:
+            # 先通知其他rank，再在本rank抛出原异常
+            broadcast_state(_SrcError('%s: %s' % (type(e).__name__, e)), src, bucket_mb)
+            raise
+    obj = broadcast_state(obj, src, bucket_mb)
+    if isinstance(obj, _SrcError):
+        raise RuntimeError('rank %d failed: %s' % (src, obj.message))
+    return obj
@@ -0,0 +1,57 @@
+import torch
+
+
+class ScalarAccumulator():
+    '''在设备上累加loss等标量，flush时一次性拷贝到主机并求均值，
+    避免每个step把tensor转为python float造成的设备同步。
+
+    示例:
+    ```python
+    acc = ScalarAccumulator()
+    acc.add({'loss': loss})
+    if step % 10 == 0:
+        means = acc.flush()   # {'loss': float}
+    ```
+    '''
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, scalars:dict):
+        '''累加一组标量
+        :param scalars: dict, {name: tensor或数值}，值为None的忽略
+        '''
+        if scalars is None:
+            return
+        for k, v in scalars.items():
+            if v is None:
+                continue
+            if isinstance(v, torch.Tensor):
+                v = v.detach().float()
+                if v.dim() > 0:
+                    v = v.mean()
+            else:
+                v = float(v)
+            if k in self.sums:
+                self.sums[k] = self.sums[k] + v
+            else:
+                self.sums[k] = v
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    def flush(self):
+        '''返回上次flush以来各标量的均值并清空
+        :return: dict, {name: float}
+        '''
+        host_vals = {}
+        tensor_keys = [k for k, v in self.sums.items() if isinstance(v, torch.Tensor)]
+        if len(tensor_keys) > 0:
+            device = self.sums[tensor_keys[0]].device
+            # 只做一次设备到主机的拷贝
+            vals = torch.stack([self.sums[k].to(device) for k in tensor_keys]).cpu().tolist()
+            host_vals = dict(zip(tensor_keys, vals))
+        res = {}
+        for k, v in self.sums.items():
+            res[k] = host_vals.get(k, v) / self.counts[k]
+        self.sums = {}
+        self.counts = {}
+        return res
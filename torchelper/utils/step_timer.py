@@ -0,0 +1,142 @@
+import time
+from collections import deque
+import torch
+from torchelper.utils import logger
+
+
+class _NullPhase():
+    '''关闭计时时使用的空上下文，不做任何事情
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase():
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        if self.timer.sync_cuda:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.timer.sync_cuda:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StepTimer():
+    '''按阶段统计训练step耗时，保存最近window个值，定期输出分位数
+
+    示例:
+    ```python
+    timer = StepTimer(enabled=True, interval=100)
+    for data in timer.iter(loader, 'data'):
+        with timer.phase('forward'):
+            ...
+        if timer.step():
+            timer.report(tb_writer, global_step)
+    ```
+    Args:
+        enabled: bool, 是否开启，关闭时phase()返回空上下文，iter()原样返回
+        interval: int, 每隔多少个step输出一次统计
+        window: int, 每个阶段保留的最近耗时数量
+        percentiles: tuple, 输出的分位数
+        sync_cuda: bool, 阶段前后是否同步cuda，开启后能准确区分GPU耗时，但会降低训练速度
+    '''
+    def __init__(self, enabled:bool=False, interval:int=100, window:int=1000, percentiles=(50, 90, 99), sync_cuda:bool=False):
+        self.enabled = enabled
+        self.interval = max(1, interval)
+        self.window = window
+        self.percentiles = percentiles
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.times = {}
+        self.phases = {}
+        self.steps = 0
+
+    def phase(self, name:str):
+        '''返回统计name阶段耗时的上下文
+        '''
+        if not self.enabled:
+            return _NULL_PHASE
+        phase = self.phases.get(name, None)
+        if phase is None:
+            phase = _Phase(self, name)
+            self.phases[name] = phase
+        return phase
+
+    def iter(self, iterable, name:str='data'):
+        '''封装迭代器，统计每次取数据的等待时间
+        '''
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iterable, name)
+
+    def _timed_iter(self, iterable, name):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def record(self, name:str, secs:float):
+        times = self.times.get(name, None)
+        if times is None:
+            times = deque(maxlen=self.window)
+            self.times[name] = times
+        times.append(secs)
+
+    def step(self):
+        '''step计数，返回是否到达输出间隔
+        '''
+        if not self.enabled:
+            return False
+        self.steps += 1
+        return self.steps % self.interval == 0
+
+    def summary(self):
+        '''计算各阶段耗时的分位数和均值，单位ms
+        :return: dict, {phase: {'p50': ms, ..., 'mean': ms}}
+        '''
+        res = {}
+        for name, times in self.times.items():
+            if len(times) == 0:
+                continue
+            vals = sorted(times)
+            stat = {}
+            for p in self.percentiles:
+                idx = min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))
+                stat['p%d' % p] = vals[idx] * 1000
+            stat['mean'] = sum(vals) / len(vals) * 1000
+            res[name] = stat
+        return res
+
+    def report(self, tb_writer=None, global_step:int=0):
+        '''将统计结果写入tensorboard和日志
+        :param tb_writer: AsyncTBLogger, 所有统计值作为一条scalar日志提交，为None时只写日志
+        '''
+        summary = self.summary()
+        if tb_writer is not None:
+            scalars = {}
+            for name, stat in summary.items():
+                for k, v in stat.items():
+                    scalars['time/%s/%s' % (name, k)] = v
+            tb_writer.add('scalar', scalars, global_step)
+        msg = []
+        for name, stat in summary.items():
+            msg.append('%s: %s' % (name, ', '.join(['%s=%.2fms' % (k, v) for k, v in stat.items()])))
+        logger.log('step time [%d]\n  ' % global_step + '\n  '.join(msg))
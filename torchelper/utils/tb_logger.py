@@ -0,0 +1,101 @@
+import queue
+import threading
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from torchelper.utils import logger
+
+
+class AsyncTBLogger():
+    '''异步写tensorboard，训练线程只做显存内的快照拷贝，
+    设备到主机的拷贝、图片/音频编码和写文件都在后台线程完成。
+
+    示例:
+    ```python
+    tb = AsyncTBLogger(ckpt_dir, intervals={'metric': 10, 'image': 500})
+    if tb.is_due('image', it):
+        tb.add('image', builder.get_img_dict(), global_step)
+    tb.close()
+    ```
+    Args:
+        log_dir: str, tensorboard日志目录
+        intervals: dict, 各类别的写入间隔（step数），<=0表示不写，类别: metric, image, audio,
+            scalar类别由调用方按自己的间隔提交
+        max_queue: int, 后台队列最大长度，队列满时丢弃新的快照，保证日志不会占满内存/显存
+        sample_rate: int, 音频采样率
+    '''
+    def __init__(self, log_dir:str, intervals:dict=None, max_queue:int=16, sample_rate:int=16000):
+        self.writer = SummaryWriter(log_dir)
+        self.intervals = {'metric': 10, 'image': 500, 'audio': 500}
+        if intervals is not None:
+            self.intervals.update(intervals)
+        if 'scalar' in self.intervals:
+            logger.warn("tb intervals['scalar'] is ignored, scalars are submitted at the caller's interval (cfg['scalar_interval'])")
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=max(1, max_queue))
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def is_due(self, category:str, it:int):
+        '''第it个step是否需要写category类别的日志
+        '''
+        interval = self.intervals.get(category, 1)
+        return interval > 0 and it % interval == 0
+
+    def _snapshot(self, v):
+        if isinstance(v, torch.Tensor):
+            # 只在设备上拷贝一份，避免被训练中的原地操作修改
+            return v.detach().clone()
+        if isinstance(v, np.ndarray):
+            return v.copy()
+        return v
+
+    def add(self, category:str, values:dict, step:int):
+        '''提交一组日志到后台线程
+        :param category: str, scalar/metric/image/audio
+        :param values: dict, {tag: value}
+        :param step: int, 写入tensorboard的step
+        '''
+        if values is None or len(values) == 0:
+            return
+        snap = {}
+        for k, v in values.items():
+            if v is None:
+                logger.warn(k+" is None ... ")
+                continue
+            snap[k] = self._snapshot(v)
+        try:
+            self.queue.put_nowait((category, snap, step))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, category, values, step):
+        for k, v in values.items():
+            if isinstance(v, torch.Tensor):
+                v = v.cpu()
+            if category == 'image':
+                self.writer.add_image(k, v, step)
+            elif category == 'audio':
+                self.writer.add_audio(k, v, step, sample_rate=self.sample_rate)
+            else:
+                self.writer.add_scalar(k, float(v), step)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print('tensorboard write failed:', e)
+
+    def close(self):
+        '''等待队列中的日志写完并关闭
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.dropped > 0:
+            logger.warn('tensorboard queue full, dropped %d snapshots' % self.dropped)
@@ -0,0 +1,85 @@
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+from torchelper.utils.dist_util import get_rank
+from torchelper.data.base_dataset import get_data_loader
+
+
+class Validator():
+    '''分布式验证：用DistributedSampler把验证集分到各个rank上，在inference_mode下执行
+    ModelBuilder.validate，各key的求和与计数保存在设备上，最后用一次all_reduce汇总。
+
+    注意：DistributedSampler会重复少量样本，使每个rank的batch数相同，
+    因此验证集大小不能被rank数整除时，均值中会多算至多rank数-1个样本。
+    Args:
+        dataset: 验证集
+        batch_size: int, 每个rank的batch大小
+        num_workers: int
+        pin_memory: bool
+    '''
+    def __init__(self, dataset, batch_size:int, num_workers:int=0, pin_memory:bool=True):
+        self.dataset = dataset
+        self.loader = get_data_loader(batch_size, dataset, num_workers=num_workers, pin_memory=pin_memory,
+                                      dist=dist.is_available() and dist.is_initialized(),
+                                      shuffle=False, drop_last=False)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _sync_keys(self, keys):
+        '''各rank返回的key可能不同，取并集并排序，保证all_reduce时顺序一致
+        '''
+        if not (dist.is_available() and dist.is_initialized()):
+            return sorted(keys)
+        all_keys = [None] * dist.get_world_size()
+        dist.all_gather_object(all_keys, sorted(keys))
+        merged = set()
+        for ks in all_keys:
+            merged.update(ks)
+        return sorted(merged)
+
+    def run(self, net, epoch:int):
+        '''执行验证集
+        :param net: ModelBuilder子类实例，需实现validate(epoch, data)，返回dict或None
+        :param epoch: int, 当前epoch
+        :return: dict, 各key在整个验证集上的均值
+        '''
+        net.set_eval()
+        device = net.device
+        sums = {}
+        counts = {}
+        loader = tqdm(self.loader) if get_rank() == 0 else self.loader
+        with torch.inference_mode():
+            for data in loader:
+                res = net.validate(epoch, data)
+                if res is None:
+                    continue
+                for key, val in res.items():
+                    if val is None:
+                        continue
+                    val = torch.as_tensor(val, dtype=torch.float64, device=device)
+                    if val.dim() > 0:
+                        val = val.mean()
+                    sums[key] = val + sums[key] if key in sums else val
+                    counts[key] = counts.get(key, 0) + 1
+
+            keys = self._sync_keys(sums.keys())
+            if len(keys) == 0:
+                return {}
+            zero = torch.zeros((), dtype=torch.float64, device=device)
+            stat = torch.stack([sums.get(k, zero) for k in keys] +
+                               [torch.tensor(float(counts.get(k, 0)), dtype=torch.float64, device=device) for k in keys])
+            if dist.is_available() and dist.is_initialized():
+                dist.all_reduce(stat)
+            stat = stat.cpu().tolist()
+
+        val_data = {}
+        for i, key in enumerate(keys):
+            count = stat[len(keys) + i]
+            if count > 0:
+                val_data[key] = stat[i] / count
+        if get_rank() == 0:
+            line = 'epoch: '+str(epoch)+', '
+            line = line + ', '.join([key + ":" + str(val) for key, val in val_data.items()])
+            print(line)
+        return val_data